@@ -0,0 +1,94 @@
+import threading
+import time
+from datetime import datetime
+
+import sqlalchemy
+import stravalib.model
+
+from backend.db import get_engine, upsert
+from backend.models import AthleteProfile
+
+_athlete_cache = None
+_athlete_cache_lock = threading.Lock()
+
+
+class AthleteCache:
+    """
+    The Strava athletes (stravalib.model.DetailedAthlete) already fetched, kept
+    for `ttl` seconds in memory and, if `with_db` is set, in the athlete_profiles
+    table so that a restart does not fetch them again.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: a dictionary as returned by readconfig.read_config
+        """
+        self.config = config
+        self.ttl = config['athlete_ttl']
+        self.with_db = config['athlete_cache_db']
+        # {athlete_id: (athlete, time of the fetch)}
+        self.athletes = {}
+        self.lock = threading.Lock()
+
+    def get(self, athlete_id):
+        """
+        Return (athlete, time of the fetch) if the athlete was fetched less than
+        `ttl` seconds ago, None otherwise
+
+        :param athlete_id: the strava id of the athlete
+        """
+        with self.lock:
+            cached = self.athletes.get(athlete_id)
+        if cached is not None and time.time() - cached[1] < self.ttl:
+            return cached
+        if not self.with_db:
+            return None
+        with sqlalchemy.orm.Session(get_engine(self.config)) as session:
+            row = session.query(AthleteProfile.data, AthleteProfile.fetched).filter(AthleteProfile.athlete == athlete_id).first()
+        if row is None or time.time() - row.fetched.timestamp() >= self.ttl:
+            return None
+        cached = (stravalib.model.DetailedAthlete.model_validate_json(row.data), row.fetched.timestamp())
+        with self.lock:
+            self.athletes[athlete_id] = cached
+        return cached
+
+    def put(self, athlete: stravalib.model.DetailedAthlete):
+        """
+        Cache an athlete just fetched from Strava
+        """
+        fetched = time.time()
+        with self.lock:
+            self.athletes[athlete.id] = (athlete, fetched)
+        if self.with_db:
+            row = {'athlete': athlete.id, 'data': athlete.model_dump_json(exclude_none=True),
+                   'fetched': datetime.fromtimestamp(int(fetched))}
+            with sqlalchemy.orm.Session(get_engine(self.config)) as session:
+                upsert(session, AthleteProfile.__table__, [row], ['data', 'fetched'])
+                session.commit()
+
+    def invalidate(self, athlete_id):
+        """
+        Forget an athlete, e.g. after a token refresh or a change of its gears
+
+        :param athlete_id: the strava id of the athlete
+        """
+        with self.lock:
+            self.athletes.pop(athlete_id, None)
+        if self.with_db:
+            with sqlalchemy.orm.Session(get_engine(self.config)) as session:
+                session.query(AthleteProfile).filter(AthleteProfile.athlete == athlete_id).delete(synchronize_session=False)
+                session.commit()
+
+
+def get_athlete_cache(config):
+    """
+    Return the athlete cache shared by the whole process
+
+    :param config: a dictionary as returned by readconfig.read_config
+    """
+    global _athlete_cache
+    if _athlete_cache is None:
+        with _athlete_cache_lock:
+            if _athlete_cache is None:
+                _athlete_cache = AthleteCache(config)
+    return _athlete_cache
@@ -0,0 +1,214 @@
+from datetime import date, datetime, timedelta
+
+import numpy
+import sqlalchemy
+
+from backend.db import upsert
+from backend.models import Activity, ActivityCurve, PeriodCurve
+
+# Durations in seconds of the points of the curves
+DURATIONS = numpy.array([1, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 420, 600, 900, 1200, 1800, 2700,
+                         3600, 5400, 7200, 10800, 14400, 18000, 21600])
+# Curve kind: the stream it is computed from. watts gives the mean-maximal
+# power, velocity_smooth the best average speed, i.e. the best pace.
+KINDS = {'watts': 'watts', 'speed': 'velocity_smooth'}
+PERIODS = ('year', 'season')
+# The seasons start on November 1st, after the end of the racing season
+SEASON_START_MONTH = 11
+ROLLING_DAYS = 90
+# Longer gaps between two samples are pauses, the values are 0 in between
+MAX_GAP = 10
+
+
+def period_starts(day):
+    """
+    Return the (period, first day) pairs of the periods containing `day`
+    """
+    day = day.date() if isinstance(day, datetime) else day
+    season_year = day.year if day.month >= SEASON_START_MONTH else day.year - 1
+    return (('year', date(day.year, 1, 1)),
+            ('season', date(season_year, SEASON_START_MONTH, 1)))
+
+
+def per_second(time, values):
+    """
+    Resample a stream on a grid of one second, from its first sample. The
+    values are interpolated linearly across gaps of at most MAX_GAP seconds
+    and set to 0 during longer pauses.
+
+    :param time: the increasing times of the samples in seconds
+
+    :param values: the values of the samples
+    """
+    time = numpy.asarray(time, dtype=numpy.float64)
+    seconds = numpy.arange(int(time[-1] - time[0]) + 1, dtype=numpy.float64) + time[0]
+    grid = numpy.interp(seconds, time, values)
+    gaps = numpy.diff(time)
+    if len(gaps) and gaps.max() > MAX_GAP:
+        after = numpy.clip(numpy.searchsorted(time, seconds, side='right'), 1, len(time) - 1)
+        paused = (gaps[after - 1] > MAX_GAP) & (seconds != time[after - 1]) & (seconds != time[after])
+        grid[paused] = 0
+    return grid
+
+
+def mean_max(grid, durations=DURATIONS):
+    """
+    Return the best average of `grid` over every duration, NaN for the
+    durations longer than the grid. Every duration is one vectorised pass over
+    the cumulative sums of the grid.
+
+    :param grid: values sampled every second, see per_second
+
+    :param durations: the window lengths in seconds
+    """
+    sums = numpy.concatenate(([0.0], numpy.cumsum(grid, dtype=numpy.float64)))
+    curve = numpy.full(len(durations), numpy.nan)
+    for i, duration in enumerate(durations):
+        if duration > len(grid):
+            break
+        curve[i] = (sums[duration:] - sums[:-duration]).max() / duration
+    return curve
+
+
+def activity_curves(read):
+    """
+    Return the curves {kind: array} of an activity
+
+    :param read: a function returning the values of a stream column by name, or
+    None if the activity has no such stream
+    """
+    time = read('time')
+    curves = {}
+    if time is None or len(time) < 2:
+        return curves
+    for kind, column in KINDS.items():
+        values = read(column)
+        if values is not None:
+            curves[kind] = mean_max(per_second(time, values))
+    return curves
+
+
+def encode(curve):
+    return numpy.asarray(curve, dtype='<f4').tobytes()
+
+
+def decode(data):
+    return numpy.frombuffer(data, dtype='<f4').astype(numpy.float64)
+
+
+def merge(curves):
+    """
+    Return the point-wise maximum of a list of curves, ignoring the NaN
+    """
+    result = numpy.full(len(DURATIONS), numpy.nan)
+    for curve in curves:
+        result = numpy.fmax(result, curve)
+    return result
+
+
+def to_json(curve):
+    return [None if numpy.isnan(value) else round(float(value), 3) for value in curve]
+
+
+class CurvesMerge:
+    """
+    Accumulate the curves of new activities, then max-merge them into the
+    period curves with one SELECT and one upsert. The history of the periods is
+    never read again.
+    """
+
+    def __init__(self):
+        self.curves = {}
+
+    def add(self, athlete_id, sport_type, day, kind, curve):
+        """
+        Merge the curve of an activity into the curves of its periods
+        """
+        if day is None:
+            return
+        for period, start in period_starts(day):
+            key = (athlete_id, kind, sport_type or '', period, start)
+            current = self.curves.get(key)
+            self.curves[key] = curve if current is None else numpy.fmax(current, curve)
+
+    def apply(self, session: sqlalchemy.orm.Session, chunk_size=500):
+        """
+        Write the accumulated curves by chunks of `chunk_size`. The session is not committed.
+        """
+        items = list(self.curves.items())
+        self.curves = {}
+        key_columns = [PeriodCurve.athlete, PeriodCurve.kind, PeriodCurve.sport_type, PeriodCurve.period, PeriodCurve.start]
+        for i in range(0, len(items), chunk_size):
+            chunk = dict(items[i:i + chunk_size])
+            current = {tuple(row[:5]): decode(row[5]) for row in session.query(*key_columns, PeriodCurve.curve)
+                       .filter(sqlalchemy.tuple_(*key_columns).in_(list(chunk.keys()))).all()}
+            rows = []
+            for key, curve in chunk.items():
+                if key in current:
+                    curve = numpy.fmax(current[key], curve)
+                rows.append(dict(zip(('athlete', 'kind', 'sport_type', 'period', 'start'), key), curve=encode(curve)))
+            upsert(session, PeriodCurve.__table__, rows, ['curve'])
+
+
+def refresh_period_curves(session: sqlalchemy.orm.Session, athlete_id: int, changes):
+    """
+    Recompute from the activity curves only the period curves containing
+    activities whose sport type or date changed. The session is not committed.
+
+    :param session: a database session
+
+    :param athlete_id: the strava id of the athlete
+
+    :param changes: (sport_type, date) pairs, the old and new values of the changed activities
+    """
+    keys = {(sport_type or '', period, start) for sport_type, day in changes if day is not None
+            for period, start in period_starts(day)}
+    if not keys:
+        return
+    key_columns = [PeriodCurve.sport_type, PeriodCurve.period, PeriodCurve.start]
+    session.query(PeriodCurve).filter(PeriodCurve.athlete == athlete_id, sqlalchemy.tuple_(*key_columns).in_(list(keys))) \
+        .delete(synchronize_session=False)
+    merged = CurvesMerge()
+    for sport_type, period, start in keys:
+        # The years and the seasons both last one year
+        end = date(start.year + 1, start.month, 1)
+        same_sport = Activity.sport_type == sport_type if sport_type else \
+            sqlalchemy.or_(Activity.sport_type.is_(None), Activity.sport_type == '')
+        for row in session.query(ActivityCurve.kind, ActivityCurve.curve)\
+                .join(Activity, Activity.id == ActivityCurve.activity_id)\
+                .filter(ActivityCurve.athlete == athlete_id, same_sport, Activity.date >= start, Activity.date < end):
+            key = (athlete_id, row.kind, sport_type, period, start)
+            current = merged.curves.get(key)
+            curve = decode(row.curve)
+            merged.curves[key] = curve if current is None else numpy.fmax(current, curve)
+    merged.apply(session)
+
+
+def rebuild_period_curves(session: sqlalchemy.orm.Session, athlete_id: int):
+    """
+    Recompute the period curves of an athlete from the activity curves, e.g.
+    after deleting activities or changing their sport type. The session is not committed.
+
+    :param session: a database session
+
+    :param athlete_id: the strava id of the athlete
+    """
+    session.query(PeriodCurve).filter(PeriodCurve.athlete == athlete_id).delete(synchronize_session=False)
+    merged = CurvesMerge()
+    for row in session.query(ActivityCurve.kind, ActivityCurve.curve, Activity.sport_type, Activity.date)\
+            .join(Activity, Activity.id == ActivityCurve.activity_id)\
+            .filter(ActivityCurve.athlete == athlete_id).yield_per(1000):
+        merged.add(athlete_id, row.sport_type, row.date, row.kind, decode(row.curve))
+    merged.apply(session)
+
+
+def rolling_curve(session: sqlalchemy.orm.Session, athlete_id: int, kind: str, sport_type=None, days=ROLLING_DAYS):
+    """
+    Return the curve of the last `days` days, merged from the activity curves
+    """
+    query = session.query(ActivityCurve.curve).join(Activity, Activity.id == ActivityCurve.activity_id)\
+        .filter(ActivityCurve.athlete == athlete_id, ActivityCurve.kind == kind,
+                Activity.date >= datetime.now() - timedelta(days=days))
+    if sport_type is not None:
+        query = query.filter(Activity.sport_type == sport_type)
+    return merge(decode(row.curve) for row in query.all())
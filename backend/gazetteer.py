@@ -0,0 +1,203 @@
+import csv
+import math
+import os
+import shutil
+import threading
+
+import numpy
+
+from backend.geocache import EARTH_RADIUS
+
+# Columns of the GeoNames postal codes dumps (https://download.geonames.org/export/zip/)
+COUNTRY_CODE = 0
+POSTAL_CODE = 1
+PLACE_NAME = 2
+LATITUDE = 9
+LONGITUDE = 10
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def to_xyz(lat, lon):
+    """
+    Return the unit vector of a (latitude, longitude) pair. The euclidean
+    distance between two such vectors grows with the great circle distance.
+    """
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    return (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+
+
+def format_place(country, postcode, place):
+    """
+    Return a location in the format used by utils.get_location
+    """
+    if country == 'FR' and postcode:
+        return f"{place} ({postcode[0:2]})"
+    return place
+
+
+class Gazetteer:
+    """
+    Offline reverse geocoder.
+
+    The places are stored in an implicit k-d tree: for any range [lo, hi) of
+    the arrays, the node is the element at the middle, the left subtree is
+    [lo, mid) and the right one is [mid + 1, hi). The split axis cycles with the
+    depth. The arrays are saved as .npy files and memory-mapped when loading.
+    """
+    POINTS = 'points.npy'
+    OFFSETS = 'offsets.npy'
+    LABELS = 'labels.npy'
+
+    def __init__(self, points, offsets, labels, radius):
+        """
+        :param points: a (n, 3) array of unit vectors in k-d tree order
+
+        :param offsets: a (n + 1) array, the label of point i is labels[offsets[i]:offsets[i+1]]
+
+        :param labels: the utf-8 encoded labels concatenated
+
+        :param radius: the maximum distance in meters of a place to a point
+        """
+        self.points = points
+        self.offsets = offsets
+        self.labels = labels
+        # Chord length corresponding to the radius
+        chord = 2 * math.sin(radius / (2 * EARTH_RADIUS))
+        self.max_dist2 = chord * chord
+
+    @classmethod
+    def read_csv(cls, csv_file):
+        """
+        Parse a GeoNames postal codes file and return the coordinates and labels
+        """
+        coordinates = []
+        labels = []
+        with open(csv_file, encoding='utf8', newline='') as f:
+            for row in csv.reader(f, delimiter='\t'):
+                try:
+                    lat = float(row[LATITUDE])
+                    lon = float(row[LONGITUDE])
+                except (IndexError, ValueError):
+                    continue
+                coordinates.append(to_xyz(lat, lon))
+                labels.append(format_place(row[COUNTRY_CODE], row[POSTAL_CODE], row[PLACE_NAME]))
+        return numpy.array(coordinates, dtype=numpy.float64).reshape(-1, 3), labels
+
+    @staticmethod
+    def build_tree(points):
+        """
+        Return the permutation sorting `points` in k-d tree order
+        """
+        order = numpy.arange(len(points))
+        stack = [(0, len(points), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo < 2:
+                continue
+            mid = (lo + hi) // 2
+            axis = depth % 3
+            sub = order[lo:hi]
+            order[lo:hi] = sub[numpy.argpartition(points[sub, axis], mid - lo)]
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+        return order
+
+    @classmethod
+    def build(cls, csv_file, cache_dir):
+        """
+        Build the k-d tree from `csv_file` and save it into `cache_dir`
+        """
+        points, labels = cls.read_csv(csv_file)
+        order = cls.build_tree(points)
+        encoded = [labels[i].encode('utf8') for i in order]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(label) for label in encoded], out=offsets[1:])
+        tmp_dir = cache_dir + '.tmp'
+        os.makedirs(tmp_dir, exist_ok=True)
+        numpy.save(os.path.join(tmp_dir, cls.POINTS), points[order])
+        numpy.save(os.path.join(tmp_dir, cls.OFFSETS), offsets)
+        numpy.save(os.path.join(tmp_dir, cls.LABELS), numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8))
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.rename(tmp_dir, cache_dir)
+
+    @classmethod
+    def load(cls, csv_file, cache_dir, radius):
+        """
+        Memory-map the k-d tree saved in `cache_dir`. It is rebuilt first if
+        it does not exist or is older than `csv_file`.
+        """
+        points_file = os.path.join(cache_dir, cls.POINTS)
+        if not os.path.exists(points_file) or os.path.getmtime(points_file) < os.path.getmtime(csv_file):
+            print(f"Building the gazetteer index of {csv_file} into {cache_dir}")
+            cls.build(csv_file, cache_dir)
+        return cls(numpy.load(points_file, mmap_mode='r'),
+                   numpy.load(os.path.join(cache_dir, cls.OFFSETS), mmap_mode='r'),
+                   numpy.load(os.path.join(cache_dir, cls.LABELS), mmap_mode='r'),
+                   radius)
+
+    def nearest(self, lat, lon):
+        """
+        Return the index of the closest place within the radius or -1
+        """
+        q = to_xyz(lat, lon)
+        points = self.points
+        best = -1
+        best_dist2 = self.max_dist2
+        stack = [(0, len(points), 0, 0.0)]
+        while stack:
+            lo, hi, depth, plane_dist2 = stack.pop()
+            if lo >= hi or plane_dist2 >= best_dist2:
+                continue
+            mid = (lo + hi) >> 1
+            x, y, z = points[mid].tolist()
+            dist2 = (q[0] - x) ** 2 + (q[1] - y) ** 2 + (q[2] - z) ** 2
+            if dist2 < best_dist2:
+                best = mid
+                best_dist2 = dist2
+            axis = depth % 3
+            diff = q[axis] - (x, y, z)[axis]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            # Push the far side first so that the near side is explored first
+            stack.append((far[0], far[1], depth + 1, diff * diff))
+            stack.append((near[0], near[1], depth + 1, 0.0))
+        return best
+
+    def get_location(self, cords):
+        """
+        Return the closest place to a pair of (latitude, longitude) coordinates
+        in the same format as utils.get_location, or None if there is no place
+        within the radius.
+
+        :param cords: a pair of (latitude, longitude) coordinates
+        """
+        if cords is None:
+            return None
+        index = self.nearest(cords.lat, cords.lon)
+        if index < 0:
+            return None
+        return bytes(self.labels[self.offsets[index]:self.offsets[index + 1]]).decode('utf8')
+
+
+def get_gazetteer(config):
+    """
+    Return the gazetteer shared by the whole process or None if the offline
+    geocoder is not enabled in the configuration.
+
+    :param config: a dictionary as returned by readconfig.read_config
+    """
+    global _gazetteer
+    if config['geocoder'] != 'offline':
+        return None
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                csv_file = config['gazetteer']
+                cache_dir = config['gazetteer_cache'] or csv_file + '.kdtree'
+                _gazetteer = Gazetteer.load(csv_file, cache_dir, config['gazetteer_radius'])
+    return _gazetteer
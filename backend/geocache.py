@@ -0,0 +1,131 @@
+import math
+import threading
+from datetime import datetime
+
+import sqlalchemy
+
+from backend.metrics import GEOCODER_LOOKUPS
+from backend.models import GeoCode
+from backend.utils import get_location
+
+EARTH_RADIUS = 6371000.0  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Return the great circle distance in meters between two points
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class GeoCache:
+    """
+    Persistent cache of reverse geocoding results.
+
+    Points are stored on a grid of GRID_STEP degrees. A lookup reuses the
+    location of the closest cached point within `radius` meters and only calls
+    Nominatim when there is none.
+    """
+    GRID_STEP = 0.01
+    # Process-wide counters
+    hits = 0
+    misses = 0
+    _lock = threading.Lock()
+
+    def __init__(self, session: sqlalchemy.orm.Session, radius=1000, max_size=10000):
+        """
+        :param session: the session used to read and write the `geocodes` table.
+        The changes are committed together with the activities.
+
+        :param radius: the distance in meters under which a cached location is reused
+
+        :param max_size: the maximum number of cached points
+        """
+        self.session = session
+        self.radius = radius
+        self.max_size = max_size
+
+    @classmethod
+    def cell(cls, value):
+        return int(math.floor(value / cls.GRID_STEP))
+
+    @classmethod
+    def _count(cls, hit):
+        with cls._lock:
+            if hit:
+                cls.hits += 1
+            else:
+                cls.misses += 1
+        GEOCODER_LOOKUPS.inc('cache' if hit else 'nominatim')
+
+    @classmethod
+    def stats(cls):
+        """
+        Return the hit and miss counters since the process started
+        """
+        return {"hits": cls.hits, "misses": cls.misses}
+
+    def lookup(self, lat, lon):
+        """
+        Return the closest cached entry within `self.radius` meters or None
+        """
+        span_lat = math.ceil(self.radius / METERS_PER_DEGREE / self.GRID_STEP)
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        span_lon = math.ceil(self.radius / (METERS_PER_DEGREE * cos_lat) / self.GRID_STEP)
+        lat_cell = self.cell(lat)
+        lon_cell = self.cell(lon)
+        candidates = self.session.query(GeoCode) \
+            .filter(GeoCode.lat_cell.between(lat_cell - span_lat, lat_cell + span_lat)) \
+            .filter(GeoCode.lon_cell.between(lon_cell - span_lon, lon_cell + span_lon)) \
+            .all()
+        best = None
+        best_distance = self.radius
+        for candidate in candidates:
+            d = distance(lat, lon, candidate.lat, candidate.lon)
+            if d <= best_distance:
+                best = candidate
+                best_distance = d
+        return best
+
+    def get_location(self, cords):
+        """
+        Same as utils.get_location but go through the cache first
+
+        :param cords: a pair of (latitude, longitude) coordinates
+        """
+        if cords is None:
+            return None
+        entry = self.lookup(cords.lat, cords.lon)
+        if entry is not None:
+            self._count(True)
+            entry.hits += 1
+            entry.last_used = datetime.now()
+            return entry.location
+        self._count(False)
+        location = get_location(cords)
+        # Do not remember failures
+        if location:
+            self.store(cords.lat, cords.lon, location)
+        return location
+
+    def store(self, lat, lon, location):
+        """
+        Add a point to the cache and evict the least recently used ones if the cache is full
+        """
+        self.session.merge(GeoCode(lat_cell=self.cell(lat), lon_cell=self.cell(lon), lat=lat, lon=lon,
+                                   location=location, hits=0, last_used=datetime.now()))
+        self.session.flush()
+        size = self.session.query(sqlalchemy.func.count(GeoCode.lat_cell)).scalar()
+        if size > self.max_size:
+            # Evict a bit more than needed so that we do not have to do it on every insert.
+            excess = size - self.max_size + self.max_size // 10
+            oldest = self.session.query(GeoCode.lat_cell, GeoCode.lon_cell) \
+                .order_by(GeoCode.last_used.asc()).limit(excess).all()
+            for lat_cell, lon_cell in oldest:
+                self.session.query(GeoCode).filter_by(lat_cell=lat_cell, lon_cell=lon_cell).delete()
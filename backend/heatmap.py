@@ -0,0 +1,242 @@
+import math
+import os
+import shutil
+import re
+import struct
+import threading
+import zlib
+
+import numpy
+
+TILE_SIZE = 256
+# Number of activities through a pixel giving the hottest colour
+SATURATION = 20
+# Distance in pixels between two points drawn along a segment
+STEP = 0.5
+# Sport types and gear ids are used in the paths of the cached tiles
+FILTER_PATTERN = re.compile(r'^\w{1,45}$')
+
+# Colour ramp from the coldest to the hottest pixel: (position, r, g, b)
+RAMP = ((0.0, 90, 0, 160), (0.35, 220, 30, 40), (0.7, 255, 160, 0), (1.0, 255, 255, 200))
+
+
+def decode_polyline(encoded):
+    """
+    Return the (lat, lng) points of a Google encoded polyline, as used by Strava,
+    as an array of shape (n, 2)
+    """
+    values = []
+    value = shift = 0
+    for char in encoded.encode('ascii'):
+        byte = char - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    points = numpy.cumsum(numpy.array(values[:len(values) // 2 * 2], dtype=numpy.int64).reshape(-1, 2), axis=0)
+    return points / 1e5
+
+
+def to_pixels(points, zoom):
+    """
+    Return the Web Mercator pixel coordinates (x, y) of (lat, lng) points at `zoom`
+    """
+    size = TILE_SIZE * (1 << zoom)
+    lat = numpy.radians(numpy.clip(points[:, 0], -85.05112878, 85.05112878))
+    x = (points[:, 1] + 180.0) / 360.0 * size
+    y = (1.0 - numpy.log(numpy.tan(lat) + 1.0 / numpy.cos(lat)) / math.pi) / 2.0 * size
+    return numpy.stack((x, y), axis=1)
+
+
+def tile_bounds(zoom, x, y):
+    """
+    Return the (south, west, north, east) bounds in degrees of a tile
+    """
+    n = 1 << zoom
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0
+
+
+def densify_segments(starts, ends, step=STEP):
+    """
+    Return points every `step` pixels along the segments (starts[i], ends[i]), ends included
+    """
+    deltas = ends - starts
+    counts = numpy.maximum(1, numpy.ceil(numpy.hypot(deltas[:, 0], deltas[:, 1]) / step)).astype(numpy.int64)
+    segment = numpy.repeat(numpy.arange(len(deltas)), counts)
+    rank = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    points = starts[segment] + deltas[segment] * (rank / counts[segment])[:, None]
+    return numpy.concatenate((points, ends))
+
+
+def densify(pixels, step=STEP):
+    """
+    Return points every `step` pixels along a line
+    """
+    if len(pixels) < 2:
+        return pixels
+    return densify_segments(pixels[:-1], pixels[1:], step)
+
+
+def render(lines, zoom, x, y):
+    """
+    Return the density of a tile: the number of lines through every pixel, as
+    an array of shape (TILE_SIZE, TILE_SIZE)
+
+    :param lines: a list of (lat, lng) arrays, see decode_polyline
+    """
+    origin = numpy.array([x * TILE_SIZE, y * TILE_SIZE], dtype=numpy.float64)
+    density = numpy.zeros(TILE_SIZE * TILE_SIZE, dtype=numpy.int32)
+    for points in lines:
+        pixels = to_pixels(points, zoom) - origin
+        if len(pixels) > 1:
+            # Only draw the segments crossing the tile
+            low = numpy.minimum(pixels[:-1], pixels[1:])
+            high = numpy.maximum(pixels[:-1], pixels[1:])
+            inside = numpy.all((high >= 0) & (low < TILE_SIZE), axis=1)
+            if not inside.any():
+                continue
+            pixels = densify_segments(pixels[:-1][inside], pixels[1:][inside])
+        cells = numpy.floor(pixels).astype(numpy.int64)
+        cells = cells[numpy.all((cells >= 0) & (cells < TILE_SIZE), axis=1)]
+        # A line counts once per pixel
+        density[numpy.unique(cells[:, 1] * TILE_SIZE + cells[:, 0])] += 1
+    return density.reshape(TILE_SIZE, TILE_SIZE)
+
+
+def _palette():
+    positions = numpy.linspace(0, 1, 256)
+    stops = numpy.array(RAMP, dtype=numpy.float64)
+    palette = numpy.zeros((256, 4), dtype=numpy.uint8)
+    for channel in range(3):
+        palette[:, channel] = numpy.interp(positions, stops[:, 0], stops[:, channel + 1]).round()
+    palette[:, 3] = (140 + 115 * positions).round()
+    palette[0] = 0
+    return palette
+
+
+PALETTE = _palette()
+
+
+def colorize(density):
+    """
+    Return the RGBA pixels of a density, on a log scale shared by all the tiles
+    """
+    level = numpy.log1p(density) / math.log1p(SATURATION)
+    index = numpy.where(density > 0, 1 + numpy.minimum(level, 1) * 254, 0).astype(numpy.uint8)
+    return PALETTE[index]
+
+
+def encode_png(rgba):
+    """
+    Return the PNG file of an array of RGBA pixels of shape (height, width, 4)
+    """
+    height, width, _ = rgba.shape
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    # Every row starts with the filter type, 0 for none
+    raw = numpy.concatenate((numpy.zeros((height, 1), dtype=numpy.uint8), rgba.reshape(height, width * 4)), axis=1)
+    return b''.join((b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+                     chunk(b'IEND', b'')))
+
+
+def touched_tiles(points, max_zoom):
+    """
+    Return {zoom: array of (x, y)} of the tiles crossed by a line at every zoom
+    up to `max_zoom`. The line is sampled once at `max_zoom`, the tiles of the
+    lower zooms are derived from these samples.
+    """
+    cells = numpy.floor(densify(to_pixels(points, max_zoom)) / TILE_SIZE).astype(numpy.int64)
+    tiles = {}
+    for zoom in range(max_zoom, -1, -1):
+        cells = numpy.unique(cells, axis=0)
+        tiles[zoom] = cells
+        cells = cells >> 1
+    return tiles
+
+
+class TileCache:
+    """
+    The heatmap tiles of an athlete rendered so far, one PNG file per filter
+    and tile in `root/<athlete_id>/<sport_type>-<gear_id>/<zoom>/<x>/<y>.png`.
+    """
+    # Incremented by every invalidation, see store
+    _generations = {}
+    _lock = threading.Lock()
+
+    def __init__(self, root, athlete_id, max_zoom):
+        self.athlete_id = athlete_id
+        self.directory = os.path.join(root, str(athlete_id))
+        self.max_zoom = max_zoom
+
+    @staticmethod
+    def filter_name(sport_type, gear_id):
+        return f"{sport_type or 'all'}-{gear_id or 'all'}"
+
+    def path(self, zoom, x, y, sport_type=None, gear_id=None):
+        return os.path.join(self.directory, self.filter_name(sport_type, gear_id), str(zoom), str(x), f"{y}.png")
+
+    def generation(self):
+        with self._lock:
+            return self._generations.get(self.athlete_id, 0)
+
+    def store(self, path, data, generation):
+        """
+        Write a rendered tile unless the tiles were invalidated since `generation`,
+        in which case it may have been rendered from outdated activities.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            if self._generations.get(self.athlete_id, 0) != generation:
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, path)
+        return True
+
+    def invalidate(self, polylines):
+        """
+        Remove the cached tiles crossed by the encoded polylines, in every filter
+
+        :param polylines: a list of encoded polylines, old and new versions of the changed activities
+        """
+        with self._lock:
+            self._generations[self.athlete_id] = self._generations.get(self.athlete_id, 0) + 1
+        try:
+            filters = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        removed = 0
+        for polyline in polylines:
+            points = decode_polyline(polyline)
+            if not len(points):
+                continue
+            for zoom, tiles in touched_tiles(points, self.max_zoom).items():
+                for name in filters:
+                    zoom_dir = os.path.join(self.directory, name, str(zoom))
+                    if not os.path.isdir(zoom_dir):
+                        continue
+                    for x, y in tiles.tolist():
+                        try:
+                            os.remove(os.path.join(zoom_dir, str(x), f"{y}.png"))
+                            removed += 1
+                        except FileNotFoundError:
+                            pass
+        if removed:
+            print(f"Heatmap: {removed} tiles invalidated for athlete {self.athlete_id}.")
+
+    def clear(self):
+        """
+        Remove all the cached tiles of the athlete
+        """
+        with self._lock:
+            self._generations[self.athlete_id] = self._generations.get(self.athlete_id, 0) + 1
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,196 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from backend.db import get_engine, remove_session
+from backend.models import Job
+from backend.stravadb import StravaRequest, StravaView
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+ACTIVE = ('queued', 'running')
+
+# What each kind of job does with a StravaView and a StravaRequest
+JOBS = {
+    'update_activities': lambda view, request: view.update_new_activities(request),
+    'rebuild_activities': lambda view, request: view.rebuild_activities(request),
+    'update_gears': lambda view, request: view.update_gears(request),
+    'update_sport_type': lambda view, request, trail_threshold: view.fix_sport_type_all_activities(request, trail_threshold),
+}
+
+
+class JobQueue:
+    """
+    Run the synchronizations with Strava in a pool of background threads.
+
+    The jobs are recorded in the jobs table with their progress. A job is not
+    queued twice for the same athlete with the same parameters, and the jobs
+    of an athlete run one at a time: they wait in a queue of the athlete, and
+    the next one is handed to the pool when the previous one finishes, so that
+    they never hold a worker needed by the other athletes.
+    """
+    # Minimal delay in seconds between two writes of the progress of a job
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self, config, workers):
+        """
+        :param config: a dictionary as returned by readconfig.read_config
+
+        :param workers: the number of jobs running at the same time
+        """
+        self.config = config
+        self.engine = get_engine(config)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        # {athlete_id: deque of the arguments of _run}, only for the athletes with a job in the pool
+        self.waiting = {}
+        # {(athlete_id, kind, parameters): job id} of the queued and running jobs
+        self.active = {}
+        self.cancel_events = {}
+        self.last_progress = {}
+        # The jobs of a previous process will never finish, pending_details lets a new job resume them.
+        with self._session() as session:
+            session.query(Job).filter(Job.status.in_(ACTIVE)) \
+                .update({Job.status: 'failed', Job.message: 'Interrupted', Job.finished: datetime.now()}, synchronize_session=False)
+            session.commit()
+
+    def _session(self):
+        # Not the session of the thread, so that the job records are committed independently.
+        return sqlalchemy.orm.Session(bind=self.engine)
+
+    def _update(self, job_id, **values):
+        with self._session() as session:
+            session.query(Job).filter(Job.id == job_id).update(values, synchronize_session=False)
+            session.commit()
+
+    @staticmethod
+    def _key(athlete_id, kind, params):
+        return athlete_id, kind, json.dumps(params, sort_keys=True, default=str)
+
+    def submit(self, athlete_id, kind, token, **params):
+        """
+        Queue a job and return its id. If a job of the same kind and with the
+        same parameters is already queued or running for the athlete, return
+        its id instead.
+
+        :param athlete_id: the strava id of the athlete
+
+        :param kind: a key of JOBS
+
+        :param token: the access token of the athlete. It is not saved in the db.
+
+        :param params: extra arguments of the job
+        """
+        if kind not in JOBS:
+            raise ValueError(f"Unknown job {kind}")
+        key = self._key(athlete_id, kind, params)
+        with self.lock:
+            # The active jobs of a previous process were marked as failed by __init__
+            existing = self.active.get(key)
+            if existing is not None:
+                return existing
+            with self._session() as session:
+                job = Job(athlete=athlete_id, kind=kind, status='queued', processed=0, total=0, created=datetime.now())
+                session.add(job)
+                session.commit()
+                job_id = job.id
+            self.active[key] = job_id
+            self.cancel_events[job_id] = threading.Event()
+            if athlete_id in self.waiting:
+                self.waiting[athlete_id].append((job_id, athlete_id, kind, token, params))
+                return job_id
+            self.waiting[athlete_id] = deque()
+        self.executor.submit(self._run, job_id, athlete_id, kind, token, params)
+        return job_id
+
+    def _next(self, athlete_id):
+        """
+        Hand the next job of the athlete to the pool, if any
+        """
+        with self.lock:
+            waiting = self.waiting[athlete_id]
+            if not waiting:
+                del self.waiting[athlete_id]
+                return
+            args = waiting.popleft()
+        self.executor.submit(self._run, *args)
+
+    def _progress(self, job_id, processed, total):
+        now = time.monotonic()
+        if processed < total and now - self.last_progress.get(job_id, 0) < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress[job_id] = now
+        self._update(job_id, processed=processed, total=total)
+
+    def _run(self, job_id, athlete_id, kind, token, params):
+        cancel = self.cancel_events[job_id]
+        view = None
+        try:
+            if cancel.is_set():
+                self._update(job_id, status='cancelled', finished=datetime.now())
+                return
+            self._update(job_id, status='running', started=datetime.now())
+            try:
+                view = StravaView(self.config, athlete_id)
+                view.cancel_event = cancel
+                view.progress = lambda processed, total: self._progress(job_id, processed, total)
+                result = JOBS[kind](view, StravaRequest(self.config, token, athlete_id=athlete_id), **params)
+                status = 'cancelled' if cancel.is_set() else 'done'
+                self._update(job_id, status=status, finished=datetime.now(), message=json.dumps(result, default=str))
+            except Exception as e:
+                print(f"Job {job_id} ({kind}) failed: {e}")
+                if view is not None:
+                    view.session.rollback()
+                self._update(job_id, status='failed', finished=datetime.now(), message=str(e))
+        finally:
+            if view is not None:
+                view.close()
+            remove_session()
+            with self.lock:
+                self.active.pop(self._key(athlete_id, kind, params), None)
+                self.cancel_events.pop(job_id, None)
+                self.last_progress.pop(job_id, None)
+            self._next(athlete_id)
+
+    def get(self, job_id, athlete_id):
+        """
+        Return the jsonified job `job_id` of the athlete or None
+        """
+        with self._session() as session:
+            job = session.query(Job).filter(Job.id == job_id, Job.athlete == athlete_id).first()
+            return job.to_json() if job is not None else None
+
+    def cancel(self, job_id, athlete_id):
+        """
+        Ask the job `job_id` of the athlete to stop and return it jsonified or None.
+        A running job stops after the batch in progress.
+        """
+        job = self.get(job_id, athlete_id)
+        if job is None:
+            return None
+        with self.lock:
+            event = self.cancel_events.get(job_id)
+        if event is not None:
+            event.set()
+        return job
+
+
+def get_job_queue(config):
+    """
+    Return the job queue shared by the whole process
+
+    :param config: a dictionary as returned by readconfig.read_config
+    """
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue(config, config['job_workers'])
+    return _job_queue
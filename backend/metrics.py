@@ -0,0 +1,242 @@
+import bisect
+import functools
+import inspect
+import math
+import threading
+import time
+
+import sqlalchemy
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The StravaView method running in the current thread, see tag_methods
+_current = threading.local()
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A value which only goes up, one per combination of label values
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """
+    A value which goes up and down
+    """
+    kind = 'gauge'
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram:
+    """
+    Counts of observations by bucket, with their sum, one per combination of label values
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # {label values: [counts of every bucket and +Inf, sum]}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        samples = []
+        names = self.labels + ('le',)
+        for key, counts in sorted(values.items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulated += count
+                samples.append((f"{self.name}_bucket", _format_labels(names, key + (_format_value(bound),)), cumulated))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), round(counts[-1], 6)))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), cumulated))
+        return samples
+
+
+class CallbackMetric:
+    """
+    A counter or a gauge whose values are read when the metrics are rendered
+
+    :param collect: a function returning {tuple of label values: value}
+    """
+
+    def __init__(self, kind, name, documentation, labels, collect):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(self.collect().items())]
+
+
+class Registry:
+    """
+    The metrics of the process, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric, or return the one already registered under its name
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_DURATION = REGISTRY.register(Histogram(
+    'mystrava_http_request_duration_seconds', "Time spent answering the requests, by handler", ('handler',)))
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'mystrava_http_requests_total', "Requests answered, by handler and status", ('handler', 'status')))
+DB_DURATION = REGISTRY.register(Histogram(
+    'mystrava_db_statement_duration_seconds', "Time spent executing SQL statements, by StravaView method", ('method',)))
+STRAVA_DURATION = REGISTRY.register(Histogram(
+    'mystrava_strava_request_duration_seconds', "Time spent on the requests to the Strava api, by endpoint", ('endpoint',)))
+STRAVA_REQUESTS = REGISTRY.register(Counter(
+    'mystrava_strava_requests_total', "Requests to the Strava api, by endpoint and status", ('endpoint', 'status')))
+GEOCODER_DURATION = REGISTRY.register(Histogram(
+    'mystrava_geocoder_request_duration_seconds', "Time spent on the reverse geocoding requests to Nominatim", ()))
+GEOCODER_LOOKUPS = REGISTRY.register(Counter(
+    'mystrava_geocoder_lookups_total', "Locations looked up, by source: gazetteer, cache or nominatim", ('source',)))
+
+
+def current_method():
+    return getattr(_current, 'method', None) or 'other'
+
+
+def reset_method():
+    """
+    Forget the current method of the thread, e.g. left by a streamed response
+    whose generator was never closed because the client went away
+    """
+    _current.method = None
+
+
+def _tagged(name, func):
+    """
+    Wrap a method to record its name as the current method while it runs. The
+    outermost method wins, e.g. push_activities called by update_new_activities
+    is counted as update_new_activities.
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(*args, **kwargs):
+            outer = getattr(_current, 'method', None)
+            _current.method = outer or name
+            try:
+                yield from func(*args, **kwargs)
+            finally:
+                _current.method = outer
+        return generator
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_current, 'method', None)
+        if outer is not None:
+            return func(*args, **kwargs)
+        _current.method = name
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.method = None
+    return wrapper
+
+
+def tag_methods(cls):
+    """
+    Class decorator tagging the SQL statements run by the public methods of
+    `cls` with the name of the method, see instrument_engine
+    """
+    for name, func in list(vars(cls).items()):
+        if not name.startswith('_') and inspect.isfunction(func):
+            setattr(cls, name, _tagged(name, func))
+    return cls
+
+
+def instrument_engine(engine):
+    """
+    Time every statement executed by `engine`, by current StravaView method
+    """
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+        starts = conn.info.get('metrics_start')
+        if starts:
+            DB_DURATION.observe(time.perf_counter() - starts.pop(), current_method())
+
+    @sqlalchemy.event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('metrics_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+    return engine
@@ -0,0 +1,104 @@
+import sqlalchemy
+
+from backend.models import Activity, Gear, PendingDetail, SchemaVersion, WebhookEvent
+
+
+def create_index(*columns, name):
+    """
+    Return a migration step creating an index on `columns` unless it already exists.
+    Base.metadata.create_all creates the indexes of the new tables, but never
+    touches the existing ones.
+    """
+    def step(connection):
+        table = columns[0].table
+        existing = [index['name'] for index in sqlalchemy.inspect(connection).get_indexes(table.name)]
+        if name not in existing:
+            sqlalchemy.Index(name, *columns).create(connection)
+    return step
+
+
+def add_columns(*columns):
+    """
+    Return a migration step adding `columns` to their table unless they already
+    exist, e.g. when create_all created the table with them.
+    """
+    def step(connection):
+        table = columns[0].table
+        existing = [column['name'] for column in sqlalchemy.inspect(connection).get_columns(table.name)]
+        for column in columns:
+            if column.name in existing:
+                continue
+            ddl = sqlalchemy.schema.CreateColumn(column).compile(dialect=connection.dialect)
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+    return step
+
+
+# Ordered upgrade steps: (version, description, step). Never modify or remove a
+# step once released, add a new one instead.
+MIGRATIONS = [
+    (1, "Index activities by athlete and date",
+     create_index(Activity.__table__.c.athlete, Activity.__table__.c.date, name='ix_activities_athlete_date')),
+    (2, "Index activities by athlete, sport type and date",
+     create_index(Activity.__table__.c.athlete, Activity.__table__.c.sport_type, Activity.__table__.c.date,
+                  name='ix_activities_athlete_sport_type_date')),
+    (3, "Index gears by athlete",
+     create_index(Gear.__table__.c.athlete, name='ix_gears_athlete')),
+    (4, "Index pending details by athlete",
+     create_index(PendingDetail.__table__.c.athlete, name='ix_pending_details_athlete')),
+    (5, "Retry the webhook events with a backoff",
+     add_columns(WebhookEvent.__table__.c.attempts, WebhookEvent.__table__.c.next_attempt)),
+]
+
+
+def get_schema_version(connection):
+    """
+    Return the version of the schema stored in the database, 0 if none
+    """
+    version = connection.execute(sqlalchemy.select(SchemaVersion.version).where(SchemaVersion.id == 1)).scalar()
+    return version or 0
+
+
+def migrate(engine: sqlalchemy.engine.Engine):
+    """
+    Apply the migrations newer than the version of the database, each one in its
+    own transaction. The tables must already exist.
+    """
+    with engine.connect() as connection:
+        current = get_schema_version(connection)
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Migrating the database to version {version}: {description}")
+        with engine.begin() as connection:
+            step(connection)
+            if current == 0:
+                connection.execute(sqlalchemy.insert(SchemaVersion).values(id=1, version=version))
+            else:
+                connection.execute(sqlalchemy.update(SchemaVersion).where(SchemaVersion.id == 1).values(version=version))
+        current = version
+
+
+def explain(session: sqlalchemy.orm.Session, query):
+    """
+    Return the plan of a query as a list of strings, one per step.
+
+    :param session: a database session
+
+    :param query: a sqlalchemy.orm.Query or a select statement
+    """
+    statement = getattr(query, 'statement', query)
+    dialect = session.get_bind().dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    if dialect.name == 'sqlite':
+        rows = session.execute(sqlalchemy.text('EXPLAIN QUERY PLAN ' + sql)).all()
+        return [row[-1] for row in rows]
+    rows = session.execute(sqlalchemy.text('EXPLAIN ' + sql)).mappings().all()
+    return [f"{row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} {row.get('Extra') or ''}"
+            for row in rows]
+
+
+def uses_index(plan, index_name):
+    """
+    Return True if a plan returned by explain uses the index `index_name`
+    """
+    return any(index_name in step for step in plan)
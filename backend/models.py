@@ -1,18 +1,63 @@
+from datetime import datetime, time
 import sqlalchemy as db
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 from backend.constants import ActivityTypes
+from backend.utils import duration_seconds
 
 Base = declarative_base()
 
+
+class Duration(db.types.TypeDecorator):
+    """
+    A duration read as a datetime.time. Stored in a TIME column on MySQL, as
+    before, and as a number of seconds on the other databases, which have no
+    TIME type accepting timedelta values. Like on MySQL, durations of a day or
+    more wrap around.
+    """
+    impl = db.Integer
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.TIME())
+        return dialect.type_descriptor(db.Integer())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'mysql':
+            return value
+        return duration_seconds(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, time):
+            return value
+        seconds = int(value)
+        return time(seconds // 3600 % 24, seconds // 60 % 60, seconds % 60)
+
+
+def Choice(*values):
+    """
+    A column taking one of `values`: an ENUM on MySQL, as before, and a plain
+    string on the other databases, so that new values sent by Strava do not
+    require a schema change.
+    """
+    return db.String(45).with_variant(mysql.ENUM(*values), 'mysql')
+
+
 class Gear(Base):
     __tablename__ = "gears"
     id = db.Column(db.String(45), primary_key=True)
     name = db.Column(db.String(256), nullable=True)
-    type = db.Column(db.Enum(ActivityTypes.HIKE, ActivityTypes.RUN, ActivityTypes.ROAD, ActivityTypes.MTB, ActivityTypes.CX, ActivityTypes.TT, ActivityTypes.GRAVEL), nullable=True)
+    type = db.Column(Choice(ActivityTypes.HIKE, ActivityTypes.RUN, ActivityTypes.ROAD, ActivityTypes.MTB, ActivityTypes.CX, ActivityTypes.TT, ActivityTypes.GRAVEL), nullable=True)
     frame_type = db.Column(db.Integer, default=0)
     athlete = db.Column(db.Integer, default=0)
     retired = db.Column(db.Boolean, default=False)
 
+    # Keep in sync with backend.migrations
+    __table_args__ = (
+        db.Index('ix_gears_athlete', 'athlete'),
+    )
+
     def to_json(self):
         return {
             "id": self.id,
@@ -33,8 +78,8 @@ class Activity(Base):
     date = db.Column(db.DateTime, nullable=True)
     distance = db.Column(db.Float, default=0)
     elevation = db.Column(db.Float, default=0)
-    moving_time = db.Column(db.Time, default=0)
-    elapsed_time = db.Column(db.Time, default=0)
+    moving_time = db.Column(Duration, default=0)
+    elapsed_time = db.Column(Duration, default=0)
     gear_id = db.Column(db.String(45), default='')
     average_speed = db.Column(db.Float, default=0)
     max_heartrate = db.Column(db.Integer, default=0)
@@ -44,8 +89,14 @@ class Activity(Base):
     description = db.Column(db.Text, default='') # COLLATE utf8mb4_bin DEFAULT NULL,
     commute = db.Column(db.Boolean, default=False)
     calories = db.Column(db.Float, default=0)
-    type = db.Column(db.Enum(*ActivityTypes.ACTIVITY_TYPES), default='')
-    sport_type = db.Column(db.Enum(*ActivityTypes.SPORT_TYPES), default='')
+    type = db.Column(Choice(*ActivityTypes.ACTIVITY_TYPES), default='')
+    sport_type = db.Column(Choice(*ActivityTypes.SPORT_TYPES), default='')
+
+    # Keep in sync with backend.migrations
+    __table_args__ = (
+        db.Index('ix_activities_athlete_date', 'athlete', 'date'),
+        db.Index('ix_activities_athlete_sport_type_date', 'athlete', 'sport_type', 'date'),
+    )
 
     def to_json(self):
         return {
@@ -70,3 +121,215 @@ class Activity(Base):
             "activity_type": self.type,
             "sport_type": self.sport_type
         }
+
+
+class GeoCode(Base):
+    """
+    Reverse geocoding results, keyed on a grid of GeoCache.GRID_STEP degrees.
+    """
+    __tablename__ = "geocodes"
+    lat_cell = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    lon_cell = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    lat = db.Column(db.Float, nullable=False)
+    lon = db.Column(db.Float, nullable=False)
+    location = db.Column(db.String(256), default='')
+    hits = db.Column(db.Integer, default=0)
+    last_used = db.Column(db.DateTime, nullable=True)
+
+
+class PendingDetail(Base):
+    """
+    Activities whose detailed fields still have to be fetched from Strava.
+    """
+    __tablename__ = "pending_details"
+    activity_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    athlete = db.Column(db.Integer, default=0)
+
+    # Keep in sync with backend.migrations
+    __table_args__ = (
+        db.Index('ix_pending_details_athlete', 'athlete'),
+    )
+
+
+class PendingStream(Base):
+    """
+    Activities whose streams still have to be fetched from Strava, see backend.streams.
+    """
+    __tablename__ = "pending_streams"
+    activity_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    athlete = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index('ix_pending_streams_athlete', 'athlete'),
+    )
+
+
+class ActivityTotal(Base):
+    """
+    Totals of the activities of an athlete by sport type, gear and period.
+    """
+    __tablename__ = "activity_totals"
+    athlete = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sport_type = db.Column(db.String(45), primary_key=True)
+    gear_id = db.Column(db.String(45), primary_key=True)
+    period = db.Column(Choice('year', 'month', 'week'), primary_key=True)
+    start = db.Column(db.Date, primary_key=True)
+    distance = db.Column(db.Float, default=0)
+    elevation = db.Column(db.Float, default=0)
+    moving_time = db.Column(db.Integer, default=0)  # seconds
+    count = db.Column(db.Integer, default=0)
+
+    def to_json(self):
+        return {
+            "sport_type": self.sport_type,
+            "gear_id": self.gear_id,
+            "period": self.period,
+            "start": self.start.strftime("%Y-%m-%d"),
+            "distance": round(self.distance, 2),
+            "elevation": self.elevation,
+            "moving_time": self.moving_time,
+            "count": self.count
+        }
+
+
+class ActivityPolyline(Base):
+    """
+    Summary polyline of an activity and its bounding box in degrees, for the heatmap.
+    """
+    __tablename__ = "activity_polylines"
+    activity_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    athlete = db.Column(db.Integer, default=0)
+    polyline = db.Column(db.Text, nullable=False)
+    south = db.Column(db.Float, nullable=False)
+    west = db.Column(db.Float, nullable=False)
+    north = db.Column(db.Float, nullable=False)
+    east = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_activity_polylines_athlete', 'athlete'),
+    )
+
+
+class ActivityCurve(Base):
+    """
+    Duration curve of an activity, see backend.curves. `curve` holds the
+    float32 values for backend.curves.DURATIONS.
+    """
+    __tablename__ = "activity_curves"
+    activity_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(16), primary_key=True)
+    athlete = db.Column(db.Integer, default=0)
+    curve = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_activity_curves_athlete_kind', 'athlete', 'kind'),
+    )
+
+
+class PeriodCurve(Base):
+    """
+    Best duration curve of an athlete by sport type and period, the maximum of
+    the curves of the activities of the period.
+    """
+    __tablename__ = "period_curves"
+    athlete = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(16), primary_key=True)
+    sport_type = db.Column(db.String(45), primary_key=True)
+    period = db.Column(Choice('year', 'season'), primary_key=True)
+    start = db.Column(db.Date, primary_key=True)
+    curve = db.Column(db.LargeBinary, nullable=False)
+
+
+class DataVersion(Base):
+    """
+    Version of the data of an athlete, incremented by every write.
+    """
+    __tablename__ = "data_versions"
+    athlete = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, default=0)
+    updated = db.Column(db.DateTime, nullable=True)  # UTC
+
+
+class SchemaVersion(Base):
+    """
+    Version of the database schema, see backend.migrations. The table has a single row.
+    """
+    __tablename__ = "schema_version"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, default=0)
+
+
+class Job(Base):
+    """
+    Background synchronization jobs, see backend.jobs.
+    """
+    __tablename__ = "jobs"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    athlete = db.Column(db.Integer, default=0)
+    kind = db.Column(db.String(45), nullable=False)
+    status = db.Column(Choice('queued', 'running', 'done', 'failed', 'cancelled'), default='queued')
+    processed = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer, default=0)
+    created = db.Column(db.DateTime, nullable=True)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+    message = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_jobs_athlete_status', 'athlete', 'status'),
+    )
+
+    def to_json(self):
+        eta = None
+        if self.status == 'running' and self.started is not None and 0 < self.processed < self.total:
+            elapsed = (datetime.now() - self.started).total_seconds()
+            eta = round(elapsed * (self.total - self.processed) / self.processed)
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "processed": self.processed,
+            "total": self.total,
+            "eta": eta,
+            "message": self.message
+        }
+
+
+class AthleteToken(Base):
+    """
+    Strava tokens of the athletes, used to apply the webhook events outside of
+    any user session, see backend.webhooks.
+    """
+    __tablename__ = "athlete_tokens"
+    athlete = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    access_token = db.Column(db.String(64), nullable=False)
+    refresh_token = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.Integer, default=0)
+
+
+class AthleteProfile(Base):
+    """
+    Strava athletes fetched recently, as JSON, see backend.athletes
+    """
+    __tablename__ = "athlete_profiles"
+    athlete = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.Text, nullable=False)
+    fetched = db.Column(db.DateTime, nullable=False)
+
+
+class WebhookEvent(Base):
+    """
+    Webhook events not applied yet. There is at most one row per object, the
+    latest event of a burst replaces the previous ones.
+    """
+    __tablename__ = "webhook_events"
+    object_type = db.Column(db.String(16), primary_key=True)
+    object_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    owner_id = db.Column(db.Integer, default=0)
+    aspect_type = db.Column(db.String(16), nullable=False)
+    updates = db.Column(db.Text, nullable=True)
+    # Microseconds, to tell apart the events of a burst
+    received = db.Column(db.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql'), nullable=False)
+    # Failed attempts to apply the event and time of the next one, see EventQueue._failed
+    attempts = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    next_attempt = db.Column(db.DateTime, nullable=True)
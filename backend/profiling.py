@@ -0,0 +1,213 @@
+import cProfile
+import hashlib
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Name of the query parameter asking to profile a request, see sign
+PARAMETER = '_profile'
+# Characters allowed in the names of the profile files
+UNSAFE = re.compile(r'[^\w.-]+')
+
+_sampler = None
+_sampler_lock = threading.Lock()
+# cProfile can only trace one thread at a time from Python 3.12
+_tracer_lock = threading.Lock()
+
+
+def sign(secret, path, expires):
+    """
+    Return the value of the _profile parameter profiling the requests to `path`
+    until `expires`
+
+    :param secret: the profile_secret of the [server] section
+
+    :param path: the path of the handler, e.g. /getRuns
+
+    :param expires: a unix time
+    """
+    digest = hmac.new(secret.encode(), f"{path}:{int(expires)}".encode(), hashlib.sha256).hexdigest()
+    return f"{int(expires)}-{digest}"
+
+
+def verify(secret, path, value):
+    """
+    Tell whether `value` is a valid and unexpired _profile parameter for `path`
+    """
+    if not secret or not value:
+        return False
+    expires, _, _ = value.partition('-')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(value, sign(secret, path, int(expires)))
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """
+    A thread taking the stack of the registered threads every `interval`
+    seconds. It only wakes up while some thread is registered, the cost of a
+    sample grows with the number of registered threads and the depth of
+    their stacks.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        # {thread id: Counter of the collapsed stacks}
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='Profile sampler', daemon=True)
+        self.thread.start()
+
+    def register(self, thread_id):
+        with self.lock:
+            self.stacks[thread_id] = Counter()
+        self.wakeup.set()
+
+    def unregister(self, thread_id):
+        """
+        Stop sampling a thread and return its stacks
+        """
+        with self.lock:
+            return self.stacks.pop(thread_id, Counter())
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def run(self):
+        me = threading.get_ident()
+        while True:
+            with self.lock:
+                thread_ids = list(self.stacks)
+            if not thread_ids:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == me:
+                    continue
+                stack = self.collapse(frame)
+                with self.lock:
+                    counts = self.stacks.get(thread_id)
+                    if counts is not None:
+                        counts[stack] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def get_sampler(interval):
+    """
+    Return the sampler shared by the whole process
+
+    :param interval: seconds between two samples, only used by the first call
+    """
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                _sampler = Sampler(interval)
+    return _sampler
+
+
+class RequestProfile:
+    """
+    The profile of a request being served in the current thread: its sampled
+    stacks and, if `trace` is set and no other request is traced, a cProfile
+    trace. A traced request is always saved, the others only when slow.
+    """
+
+    def __init__(self, sampler, trace):
+        self.sampler = sampler
+        self.traced = trace
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.stacks = Counter()
+        self.profiler = None
+        if trace and _tracer_lock.acquire(blocking=False):
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiling tool is active
+                self.profiler = None
+                _tracer_lock.release()
+        sampler.register(self.thread_id)
+
+    def stop(self):
+        """
+        Stop profiling and return the duration of the request in seconds
+        """
+        duration = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            _tracer_lock.release()
+        self.stacks = self.sampler.unregister(self.thread_id)
+        return duration
+
+    def save(self, directory, handler, duration, max_files):
+        """
+        Write the stacks to `directory/<time>-<handler>-<ms>ms.collapsed`, the
+        trace next to them with the .pstats suffix, then remove the oldest
+        profiles beyond `max_files`. The stacks are rooted at "<handler> <ms>ms"
+        to show up in the flame graphs, e.g. flamegraph.pl or speedscope.
+
+        :return: the path of the files without suffix
+        """
+        os.makedirs(directory, exist_ok=True)
+        milliseconds = round(duration * 1000)
+        name = UNSAFE.sub('_', f"{datetime.now():%Y%m%d-%H%M%S-%f}-{handler}-{milliseconds}ms")
+        path = os.path.join(directory, name)
+        root = f"{handler} {milliseconds}ms"
+        with open(f"{path}.collapsed", 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{root};{stack} {count}\n")
+        if self.profiler is not None:
+            self.profiler.dump_stats(f"{path}.pstats")
+        rotate(directory, max_files)
+        return path
+
+
+def rotate(directory, max_files):
+    """
+    Remove the oldest profiles of `directory` to keep at most `max_files` of them
+    """
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.collapsed'))
+    for name in names[:max(0, len(names) - max_files)]:
+        base = os.path.join(directory, name[:-len('.collapsed')])
+        for suffix in ('.collapsed', '.pstats'):
+            try:
+                os.remove(base + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def start(sample_rate, threshold, secret, signature, path, interval):
+    """
+    Return the profile of the current request, or None if it needs none. A
+    request is traced if it is drawn with probability `sample_rate` or if
+    `signature` is valid. The other requests are only sampled when `threshold`
+    is set, to keep them if they turn out to be slow.
+
+    :param signature: the value of the _profile parameter, see sign
+    """
+    trace = verify(secret, path, signature) or (sample_rate > 0 and random.random() < sample_rate)
+    if not trace and threshold <= 0:
+        return None
+    return RequestProfile(get_sampler(interval), trace)
@@ -0,0 +1,157 @@
+import threading
+import time
+
+from backend.metrics import REGISTRY, CallbackMetric
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    A bucket of `capacity` tokens refilled at the start of every window of
+    `period` seconds. Windows are aligned on the epoch like the Strava ones:
+    the 15 minute quota is reset at :00, :15, :30 and :45 and the daily quota at
+    midnight UTC.
+    """
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.tokens = capacity
+        self.window = self._current_window()
+
+    def _current_window(self):
+        return int(time.time() // self.period)
+
+    def refill(self):
+        window = self._current_window()
+        if window != self.window:
+            self.window = window
+            self.tokens = self.capacity
+
+    def wait_time(self):
+        """
+        Return the number of seconds before the next refill
+        """
+        return (self.window + 1) * self.period - time.time()
+
+
+class RateLimiter:
+    """
+    Thread-safe scheduler for the requests to the Strava API.
+
+    A call to `acquire` takes one token from both the 15 minute and the daily
+    buckets and blocks until the budget is available again.
+    """
+    SHORT_PERIOD = 15 * 60
+    LONG_PERIOD = 24 * 60 * 60
+    WINDOWS = ('15min', 'daily')
+
+    def __init__(self, short_limit, long_limit):
+        """
+        :param short_limit: the number of requests allowed every 15 minutes
+
+        :param long_limit: the number of requests allowed every day
+        """
+        self.buckets = (TokenBucket(short_limit, self.SHORT_PERIOD), TokenBucket(long_limit, self.LONG_PERIOD))
+        self.lock = threading.Lock()
+        # The last (limits, usages) reported by Strava, see update
+        self.reported = None
+
+    def acquire(self, cancel: threading.Event | None = None):
+        """
+        Take a token in every bucket, waiting for the next window if one is empty
+
+        :param cancel: an event to stop waiting. Return False if it is set, True otherwise
+        """
+        while True:
+            with self.lock:
+                for bucket in self.buckets:
+                    bucket.refill()
+                empty = [bucket for bucket in self.buckets if bucket.tokens <= 0]
+                if not empty:
+                    for bucket in self.buckets:
+                        bucket.tokens -= 1
+                    return True
+                wait = max(bucket.wait_time() for bucket in empty)
+            print(f"Strava rate limit reached, pausing for {wait:.0f}s")
+            # Wake up regularly to check for cancellation
+            while wait > 0:
+                if cancel is not None and cancel.is_set():
+                    return False
+                time.sleep(min(wait, 5))
+                wait -= 5
+
+
+    def update(self, headers):
+        """
+        Align the buckets on the limits and usage reported by Strava in the
+        headers of a response, which also count the requests of the other
+        processes using the same application. The read limits are used when
+        present. The tokens are only ever lowered, the local count stays the
+        reference until the next window.
+
+        :param headers: the headers of a response of the Strava api
+        """
+        for prefix in ('X-ReadRateLimit', 'X-RateLimit'):
+            limits = headers.get(f'{prefix}-Limit')
+            usages = headers.get(f'{prefix}-Usage')
+            if limits and usages:
+                break
+        else:
+            return
+        try:
+            limits = [int(value) for value in limits.split(',')]
+            usages = [int(value) for value in usages.split(',')]
+        except ValueError:
+            return
+        with self.lock:
+            self.reported = (limits, usages)
+            for bucket, limit, usage in zip(self.buckets, limits, usages):
+                bucket.refill()
+                bucket.capacity = min(bucket.capacity, limit)
+                bucket.tokens = min(bucket.tokens, max(0, limit - usage))
+
+
+    def gauges(self):
+        """
+        Return {(window, kind): value} of the local tokens and of the last limits
+        and usage reported by Strava, for /metrics
+        """
+        values = {}
+        with self.lock:
+            for window, bucket in zip(self.WINDOWS, self.buckets):
+                values[(window, 'tokens')] = bucket.tokens
+            if self.reported is not None:
+                for window, limit, usage in zip(self.WINDOWS, *self.reported):
+                    values[(window, 'limit')] = limit
+                    values[(window, 'usage')] = usage
+        return values
+
+    def exhausted(self):
+        """
+        Return True if a bucket is empty until its next window
+        """
+        with self.lock:
+            for bucket in self.buckets:
+                bucket.refill()
+            return any(bucket.tokens <= 0 for bucket in self.buckets)
+
+
+def get_rate_limiter(config):
+    """
+    Return the rate limiter shared by the whole process
+
+    :param config: a dictionary as returned by readconfig.read_config
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(config['rate_limit_15min'], config['rate_limit_daily'])
+                limiter = _rate_limiter
+                REGISTRY.register(CallbackMetric('gauge', 'mystrava_strava_rate_limit',
+                                                 "Tokens left locally, and limit and usage reported by Strava, by window",
+                                                 ('window', 'kind'), lambda: limiter.gauges()))
+    return _rate_limiter
@@ -3,6 +3,7 @@ try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
+import os
 import sys
 
 
@@ -15,21 +16,66 @@ def read_config(infile):
     parser = configparser.RawConfigParser()
     parser.read(infile)
     config = {}
+    try:
+        config['db_url'] = parser.get('database', 'url') or None
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['db_url'] = None
+
+    try:
+        config['sqlite_mmap_size'] = parser.getint('database', 'mmap_size')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['sqlite_mmap_size'] = 256 * 1024 * 1024
+
+    try:
+        config['sqlite_busy_timeout'] = parser.getint('database', 'busy_timeout')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['sqlite_busy_timeout'] = 5000
+
+    # The mysql options are only required without an explicit database url
     try:
         config['mysql_user'] = parser.get('mysql', 'user')
-    except configparser.NoOptionError:
-        print("No mysql user provided")
-        sys.exit()
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        if config['db_url'] is None:
+            print("No mysql user provided")
+            sys.exit()
+        config['mysql_user'] = ""
     try:
         config['mysql_password'] = parser.get('mysql', 'password')
-    except configparser.NoOptionError:
+    except (configparser.NoSectionError, configparser.NoOptionError):
         config['mysql_password'] = ""
 
     try:
         config['mysql_base'] = parser.get('mysql', 'base')
-    except configparser.NoOptionError:
-        print("No name provided for the mysql base")
-        sys.exit()
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        if config['db_url'] is None:
+            print("No name provided for the mysql base")
+            sys.exit()
+        config['mysql_base'] = ""
+
+    try:
+        config['mysql_sock'] = parser.get('mysql', 'sock') or None
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['mysql_sock'] = None
+
+    try:
+        config['pool_size'] = parser.getint('mysql', 'pool_size')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['pool_size'] = 5
+
+    try:
+        config['max_overflow'] = parser.getint('mysql', 'max_overflow')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['max_overflow'] = 10
+
+    try:
+        config['pool_recycle'] = parser.getint('mysql', 'pool_recycle')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['pool_recycle'] = 3600
+
+    try:
+        config['batch_size'] = parser.getint('mysql', 'batch_size')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['batch_size'] = 500
 
     try:
         config['client_id'] = parser.get('strava', 'client_id')
@@ -48,12 +94,175 @@ def read_config(infile):
     except (configparser.NoOptionError, ValueError):
         config['with_details'] = False
 
+    try:
+        config['rate_limit_15min'] = parser.getint('strava', 'rate_limit_15min')
+    except (configparser.NoOptionError, ValueError):
+        config['rate_limit_15min'] = 100
+
+    try:
+        config['rate_limit_daily'] = parser.getint('strava', 'rate_limit_daily')
+    except (configparser.NoOptionError, ValueError):
+        config['rate_limit_daily'] = 1000
+
+    try:
+        config['detail_workers'] = parser.getint('strava', 'detail_workers')
+    except (configparser.NoOptionError, ValueError):
+        config['detail_workers'] = 4
+
+    try:
+        config['http_concurrency'] = parser.getint('strava', 'http_concurrency')
+    except (configparser.NoOptionError, ValueError):
+        config['http_concurrency'] = 8
+
+    try:
+        config['http_retries'] = parser.getint('strava', 'http_retries')
+    except (configparser.NoOptionError, ValueError):
+        config['http_retries'] = 3
+
+    try:
+        config['job_workers'] = parser.getint('strava', 'job_workers')
+    except (configparser.NoOptionError, ValueError):
+        config['job_workers'] = 2
+
+    try:
+        config['webhook_verify_token'] = parser.get('strava', 'webhook_verify_token') or None
+    except configparser.NoOptionError:
+        config['webhook_verify_token'] = None
+
+    try:
+        config['webhook_subscription_id'] = parser.getint('strava', 'webhook_subscription_id')
+    except (configparser.NoOptionError, ValueError):
+        config['webhook_subscription_id'] = None
+    if config['webhook_verify_token'] is not None and config['webhook_subscription_id'] is None:
+        # Anybody could post events otherwise
+        print("No webhook_subscription_id provided, the webhook events are rejected until it is set")
+
+    try:
+        config['webhook_delay'] = parser.getint('strava', 'webhook_delay')
+    except (configparser.NoOptionError, ValueError):
+        config['webhook_delay'] = 10
+
+    try:
+        config['with_streams'] = parser.getboolean('strava', 'with_streams')
+    except (configparser.NoOptionError, ValueError):
+        config['with_streams'] = False
+
+    try:
+        config['athlete_ttl'] = parser.getint('strava', 'athlete_ttl')
+    except (configparser.NoOptionError, ValueError):
+        config['athlete_ttl'] = 3600
+
+    try:
+        config['athlete_cache_db'] = parser.getboolean('strava', 'athlete_cache_db')
+    except (configparser.NoOptionError, ValueError):
+        config['athlete_cache_db'] = False
+
+    try:
+        config['stream_dir'] = parser.get('streams', 'dir') or None
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['stream_dir'] = None
+    if config['stream_dir'] is None:
+        config['stream_dir'] = os.path.join(os.path.dirname(os.path.abspath(infile)), 'streams')
+
+    try:
+        config['tile_dir'] = parser.get('heatmap', 'dir') or None
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['tile_dir'] = None
+    if config['tile_dir'] is None:
+        config['tile_dir'] = os.path.join(os.path.dirname(os.path.abspath(infile)), 'tiles')
+
+    try:
+        config['heatmap_max_zoom'] = parser.getint('heatmap', 'max_zoom')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['heatmap_max_zoom'] = 14
+
+    try:
+        config['geocache_radius'] = parser.getint('geocoding', 'cache_radius')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['geocache_radius'] = 1000
+
+    try:
+        config['geocache_size'] = parser.getint('geocoding', 'cache_size')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['geocache_size'] = 10000
+
+    try:
+        config['geocoder'] = parser.get('geocoding', 'geocoder')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['geocoder'] = 'nominatim'
+
+    try:
+        config['gazetteer'] = parser.get('geocoding', 'gazetteer')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['gazetteer'] = None
+    if config['geocoder'] == 'offline' and not config['gazetteer']:
+        print("No gazetteer provided, using Nominatim")
+        config['geocoder'] = 'nominatim'
+
+    try:
+        config['gazetteer_cache'] = parser.get('geocoding', 'gazetteer_cache')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        config['gazetteer_cache'] = None
+
+    try:
+        config['gazetteer_radius'] = parser.getint('geocoding', 'gazetteer_radius')
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+        config['gazetteer_radius'] = 5000
+
     try:
         config['session_dir'] = parser.get('server', 'session_dir')
     except configparser.NoOptionError:
         print("No session directory defined")
         sys.exit()
 
+    try:
+        config['session_store'] = parser.get('server', 'session_store') or 'file'
+    except configparser.NoOptionError:
+        config['session_store'] = 'file'
+    if config['session_store'] not in ('file', 'memory', 'sqlite'):
+        print(f"Unknown session_store {config['session_store']}, using file")
+        config['session_store'] = 'file'
+
+    try:
+        config['session_snapshot_interval'] = parser.getint('server', 'session_snapshot_interval')
+    except (configparser.NoOptionError, ValueError):
+        config['session_snapshot_interval'] = 60
+
+    try:
+        config['compress_threshold'] = parser.getint('server', 'compress_threshold')
+    except (configparser.NoOptionError, ValueError):
+        config['compress_threshold'] = 1024
+
+    try:
+        config['fast_json'] = parser.getboolean('server', 'fast_json')
+    except (configparser.NoOptionError, ValueError):
+        config['fast_json'] = False
+
+    try:
+        config['metrics'] = parser.getboolean('server', 'metrics')
+    except (configparser.NoOptionError, ValueError):
+        config['metrics'] = False
+
+    try:
+        config['profile_sample_rate'] = parser.getfloat('server', 'profile_sample_rate')
+    except (configparser.NoOptionError, ValueError):
+        config['profile_sample_rate'] = 0.0
+
+    try:
+        config['profile_threshold'] = parser.getfloat('server', 'profile_threshold')
+    except (configparser.NoOptionError, ValueError):
+        config['profile_threshold'] = 0.0
+
+    try:
+        config['profile_secret'] = parser.get('server', 'profile_secret') or None
+    except configparser.NoOptionError:
+        config['profile_secret'] = None
+
+    try:
+        config['profile_max_files'] = parser.getint('server', 'profile_max_files')
+    except (configparser.NoOptionError, ValueError):
+        config['profile_max_files'] = 100
+
     try:
         config['proxy_base'] = parser.get('server', 'base_proxy')
     except configparser.NoOptionError:
@@ -1,12 +1,20 @@
 import os
 import cherrypy
+import backend.server.tools # pylint: disable=unused-import. Register the custom tools.
 from backend.server.serve import StravaUI
+from backend.server.sessions import SESSION_STORES
+from backend.db import init_db
+from backend.webhooks import get_event_queue
 from backend import config, app_dir
 
 
-def app():
+def app_config(frontend_dir):
+    """
+    Return the CherryPy configuration of the application
+
+    :param frontend_dir: the directory of the static files
+    """
     session_dir = config['session_dir']
-    frontend_dir = os.path.join(app_dir, 'frontend')
     if not os.path.exists(session_dir):
         os.mkdir(session_dir)
     conf = {
@@ -16,22 +24,63 @@ def app():
             # 'tools.proxy.local': "",
             'tools.encode.text_only': False,
             'tools.sessions.on': True,
-            'tools.sessions.storage_class': cherrypy.lib.sessions.FileSession,
+            'tools.sessions.storage_class': SESSION_STORES[config['session_store']],
             'tools.sessions.storage_path': session_dir,
+            # Only used by the memory and sqlite stores
+            'tools.sessions.keepalive_key': StravaUI.DUMMY,
+            'tools.sessions.snapshot_interval': config['session_snapshot_interval'],
             'tools.sessions.timeout': 60 * 24 * 30,  # 1 month
             'tools.staticdir.on': True,
             'tools.staticdir.root': frontend_dir,
             'tools.staticdir.dir': '',
             'tools.response_headers.on': True,
+            'tools.dbsession.on': True,
+            'tools.metrics.on': True,
+            'tools.compress.on': True,
+            'tools.compress.mime_types': ['application/json'],
+            'tools.compress.threshold': config['compress_threshold'],
             'log.access_file': f"{app_dir}/log/access.log",
             'log.error_file': f"{app_dir}/log/error.log."
         },
+        # Called by Strava, not by a browser
+        '/webhook': {
+            'tools.sessions.on': False,
+        },
+        # Scraped by Prometheus
+        '/metrics': {
+            'tools.sessions.on': False,
+        },
+        # Assets built by buildassets.py
+        '/build': {
+            'tools.staticdir.on': False,
+            'tools.precompressed.on': True,
+            'tools.precompressed.root': os.path.join(frontend_dir, 'build'),
+            'tools.precompressed.section': '/build',
+        },
     }
+    if config['profile_sample_rate'] > 0 or config['profile_threshold'] > 0 or config['profile_secret']:
+        conf['/'].update({
+            'tools.profiling.on': True,
+            'tools.profiling.sample_rate': config['profile_sample_rate'],
+            'tools.profiling.threshold': config['profile_threshold'],
+            'tools.profiling.secret': config['profile_secret'],
+            'tools.profiling.max_files': config['profile_max_files'],
+            'tools.profiling.directory': f"{app_dir}/log/profiles",
+        })
     if config['proxy_base']:
         conf['/']['tools.proxy.on'] = True
         conf['/']['tools.proxy.base'] = config['proxy_base']
+    return conf
 
 
+def app():
+    frontend_dir = os.path.join(app_dir, 'frontend')
+    conf = app_config(frontend_dir)
     print(conf['/'])
+    # Create the shared engine and the tables once and for all.
+    init_db(config)
+    if config['webhook_verify_token'] is not None:
+        # Apply the events received before the last shutdown
+        get_event_queue(config)
     cherrypy.config.update({'server.socket_host': '127.0.0.1', 'server.socket_port': 8080})
     cherrypy.quickstart(StravaUI(frontend_dir, config), '/', conf)
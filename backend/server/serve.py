@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
 import os.path
 import time
+from datetime import timezone
+from email.utils import parsedate_to_datetime
 import cherrypy
+from cherrypy.lib import cptools, httputil, static
 import stravalib
 import requests
 import stravalib.model
 
+from backend import serialize
+from backend.athletes import get_athlete_cache
+from backend.curves import KINDS as CURVE_KINDS, PERIODS as CURVE_PERIODS
+from backend.heatmap import FILTER_PATTERN as HEATMAP_FILTER_PATTERN
+from backend.jobs import get_job_queue
+from backend.metrics import REGISTRY
 from backend.stravadb import StravaRequest, StravaView
+from backend.streams import STREAM_TYPES
+from backend.transport import get_requests_session
+from backend.webhooks import get_event_queue
 
 
 class StravaUI:
@@ -44,14 +58,68 @@ class StravaUI:
         """
         response = cherrypy.session[self.ACCESS_TOKEN]
         if time.time() > cherrypy.session[self.EXPIRES_AT]:
-            client = stravalib.Client(access_token=response)
+            client = stravalib.Client(access_token=response, requests_session=get_requests_session(self.config))
             new_auth_response = client.refresh_access_token(client_id=self.config['client_id'], client_secret=self.config['client_secret'], refresh_token=cherrypy.session[self.REFRESH_TOKEN])
             cherrypy.session[self.ACCESS_TOKEN] = new_auth_response['access_token']
             cherrypy.session[self.REFRESH_TOKEN] = new_auth_response['refresh_token']
             cherrypy.session[self.EXPIRES_AT] = new_auth_response['expires_at']
             response = new_auth_response['access_token']
+            self._saveTokens()
+            # The athlete may have changed the scopes granted to the application
+            get_athlete_cache(self.config).invalidate(cherrypy.session.get(self.ATHLETE_ID))
         return response
 
+    def _saveTokens(self):
+        """
+        Record the tokens of the session in the db for the webhook events
+        """
+        view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
+        view.save_tokens(cherrypy.session[self.ACCESS_TOKEN], cherrypy.session[self.REFRESH_TOKEN], cherrypy.session[self.EXPIRES_AT])
+        view.close()
+
+    def _page(self, name):
+        """
+        Open an html page of the frontend, the one built by buildassets.py if it exists.
+        """
+        # The page refers to the fingerprinted assets, it must be revalidated.
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        built = os.path.join(self.rootdir, 'build', name)
+        if os.path.exists(built):
+            return open(built, encoding='utf8')
+        return open(os.path.join(self.rootdir, name), encoding='utf8')
+
+    def _validateDataVersion(self, view: StravaView):
+        """
+        Set a weak ETag and the Last-Modified header from the data version of the athlete
+        and answer 304 Not Modified if the client already has this version.
+
+        :param view: the StravaView of the athlete
+        """
+        version, updated = view.get_data_version()
+        etag = f'"{view.athlete_id}-{version}"'
+        headers = cherrypy.response.headers
+        # Weak: the compress tool sends other bytes for the same version depending on Accept-Encoding.
+        headers['ETag'] = f'W/{etag}'
+        # Always revalidate, the data may change at any time.
+        headers['Cache-Control'] = 'private, no-cache'
+        if updated is not None:
+            headers['Last-Modified'] = httputil.HTTPDate(updated.replace(tzinfo=timezone.utc).timestamp())
+        if_none_match = cherrypy.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # Weak comparison, as required for If-None-Match
+            not_modified = etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        else:
+            if_modified_since = cherrypy.request.headers.get('If-Modified-Since')
+            not_modified = False
+            if if_modified_since is not None and updated is not None:
+                try:
+                    not_modified = int(updated.replace(tzinfo=timezone.utc).timestamp()) <= parsedate_to_datetime(if_modified_since).timestamp()
+                except (TypeError, ValueError):
+                    pass
+        if not_modified:
+            view.close()
+            raise cherrypy.HTTPRedirect([], 304)
+
     @cherrypy.expose
     def index(self):
         """
@@ -62,7 +130,7 @@ class StravaUI:
         athlete_id = cherrypy.session.get(self.ATHLETE_ID)
         if athlete_id is not None and cherrypy.session.get(self.ACCESS_TOKEN) is not None:
             if not self.isAuthorized(athlete_id):
-                return open(os.path.join(self.rootdir, 'forbid.html'), encoding='utf8')
+                return self._page('forbid.html')
             cookie = cherrypy.response.cookie
             athlete_is_premium = cherrypy.session.get(self.ATHLETE_IS_PREMIUM)
             if athlete_is_premium is None:
@@ -72,7 +140,7 @@ class StravaUI:
         else:
             self.disconnect()
 
-        return open(os.path.join(self.rootdir, 'index.html'), encoding='utf8')
+        return self._page('index.html')
 
     @cherrypy.expose
     def disconnect(self):
@@ -87,24 +155,87 @@ class StravaUI:
         cookie['is_premium']['expires'] = 0
         cookie['write_access'] = 0
         cookie['write_access']['expires'] = 0
-        return open(os.path.join(self.rootdir, 'index.html'), encoding='utf8')
+        return self._page('index.html')
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
-    def getRuns(self):
+    def getRuns(self, limit=None, cursor=None, before=None, after=None, name=None, sport_type=None):
         """
         Ajax query /getRuns to extract data from the database
+
+        Without `limit`, return the list of all the activities. Otherwise, return
+        a page {"activities": [...], "next_cursor": ...} of at most `limit`
+        activities. Pass `next_cursor` back as `cursor` to get the next page.
+        The JSON is encoded straight into bytes by backend.serialize.
         """
         # Keep session alive
         cherrypy.session[self.DUMMY] = 'MyStravaGetRuns'
         athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        cherrypy.response.headers["Content-Type"] = "application/json"
         if athlete_id is None or not self.isAuthorized(athlete_id):
-            activities = ""
-        else:
-            view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-            activities = view.get_activities()
+            return b'""'
+        criterions = {'before': before, 'after': after, 'name': name, 'sport_type': sport_type}
+        view = StravaView(self.config, athlete_id)
+        self._validateDataVersion(view)
+        try:
+            if limit is None:
+                activities = view.get_activities(**criterions)
+            else:
+                activities = view.get_activities_page(int(limit), cursor, **criterions)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        finally:
             view.close()
-        return activities
+        return serialize.dumps(activities, self.config['fast_json'])
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def getCurves(self, kind='watts', period='year', sport_type=None, activity_id=None):
+        """
+        Ajax query /getCurves to get the best power (kind=watts) or speed
+        (kind=speed) for every duration by period: year, season or rolling.
+        With `activity_id`, return the curves of this activity.
+        """
+        # Keep session alive
+        cherrypy.session[self.DUMMY] = 'MyStravaGetCurves'
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            return ""
+        if kind not in CURVE_KINDS or period not in CURVE_PERIODS + ('rolling',):
+            raise cherrypy.HTTPError(400, "Invalid kind or period")
+        view = StravaView(self.config, athlete_id)
+        self._validateDataVersion(view)
+        try:
+            if activity_id is not None:
+                curves = view.get_activity_curves(int(activity_id))
+            else:
+                curves = view.get_curves(kind, period, sport_type)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid activity id")
+        finally:
+            view.close()
+        return curves
+
+    @cherrypy.expose
+    @cherrypy.config(**{'response.stream': True})
+    def streamRuns(self, before=None, after=None, name=None, sport_type=None):
+        """
+        Ajax query /streamRuns to stream the activities as newline delimited JSON
+        """
+        # Keep session alive
+        cherrypy.session[self.DUMMY] = 'MyStravaStreamRuns'
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            raise cherrypy.HTTPError(403)
+        cherrypy.response.headers["Content-Type"] = "application/x-ndjson"
+        view = StravaView(self.config, athlete_id)
+
+        def stream():
+            try:
+                for activity in view.iter_activities(before=before, after=after, name=name, sport_type=sport_type):
+                    yield serialize.dumps(activity, self.config['fast_json']) + b'\n'
+            finally:
+                view.close()
+        return stream()
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -119,11 +250,95 @@ class StravaUI:
             gears = ""
         else:
             view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
+            self._validateDataVersion(view)
             gears = view.get_gears()
             view.close()
         return gears
 
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def getTotals(self, period='year', sport_type=None, gear_id=None):
+        """
+        Ajax query /getTotals to get the totals by sport type, gear and period
+        """
+        # Keep session alive
+        cherrypy.session[self.DUMMY] = 'MyStravaGetTotals'
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            totals = ""
+        else:
+            view = StravaView(self.config, athlete_id)
+            self._validateDataVersion(view)
+            totals = view.get_totals(period, sport_type, gear_id)
+            view.close()
+        return totals
+
+
+    @cherrypy.expose
+    def getStreams(self, activity_id, types=None, points=1000, start=None, end=None):
+        """
+        Ajax query /getStreams to get the streams of an activity, reduced to at
+        most `points` points by backend.streams.downsample.
+
+        `types` is a comma separated list of streams, default to all of them.
+        `start` and `end` restrict the streams to a time range in seconds.
+        """
+        # Keep session alive
+        cherrypy.session[self.DUMMY] = 'MyStravaGetStreams'
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            return b'""'
+        try:
+            activity_id = int(activity_id)
+            points = min(max(int(points), 3), 10000)
+            start = None if start is None else float(start)
+            end = None if end is None else float(end)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid parameters")
+        names = [name for name in types.split(',') if name] if types else list(STREAM_TYPES)
+        if any(name not in STREAM_TYPES for name in names):
+            raise cherrypy.HTTPError(400, "Invalid stream type")
+        view = StravaView(self.config, athlete_id)
+        streams = view.get_streams(activity_id, names, points, start, end)
+        view.close()
+        if streams is None:
+            raise cherrypy.HTTPError(404)
+        return serialize.dumps(streams, self.config['fast_json'])
+
+
+    @cherrypy.expose
+    def heatmap(self, zoom, x, y, sport_type=None, gear_id=None):
+        """
+        Query /heatmap/<zoom>/<x>/<y>.png to get a heatmap tile of the activities,
+        optionally restricted to a sport type or a gear. The tiles are rendered
+        once and served from the tile cache until an activity crossing them changes.
+        """
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            raise cherrypy.HTTPError(403)
+        try:
+            zoom = int(zoom)
+            x = int(x)
+            y = int(y[:-4] if y.endswith('.png') else y)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid tile")
+        if not 0 <= zoom <= self.config['heatmap_max_zoom'] or not 0 <= x < 1 << zoom or not 0 <= y < 1 << zoom:
+            raise cherrypy.HTTPError(404)
+        if any(value is not None and not HEATMAP_FILTER_PATTERN.match(value) for value in (sport_type, gear_id)):
+            raise cherrypy.HTTPError(400, "Invalid filter")
+        view = StravaView(self.config, athlete_id)
+        tile = view.get_heatmap_tile(zoom, x, y, sport_type, gear_id)
+        view.close()
+        # The file is replaced when the tile is invalidated, revalidate with Last-Modified
+        cherrypy.response.headers['Cache-Control'] = 'private, no-cache'
+        if isinstance(tile, bytes):
+            cherrypy.response.headers['Content-Type'] = 'image/png'
+            return tile
+        return static.serve_file(tile, 'image/png')
+
+
     @cherrypy.expose
     def getAthleteProfile(self):
         """
@@ -131,46 +346,87 @@ class StravaUI:
         """
         cherrypy.session[self.DUMMY] = 'MyStravaGetAthleteProfile'
         cherrypy.response.headers["Content-Type"] = "text/html"
-        stravaInstance = StravaRequest(self.config, self._getOrRefreshToken())
-        profile = stravaInstance.athlete_profile
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        stravaInstance = StravaRequest(self.config, self._getOrRefreshToken(), athlete_id=athlete_id)
+        profile = stravaInstance.athlete_profile or ""
+        if stravaInstance.athlete is not None:
+            # The browser may reuse the url until the cached athlete expires
+            max_age = max(0, int(stravaInstance.athlete_fetched + self.config['athlete_ttl'] - time.time()))
+            headers = cherrypy.response.headers
+            headers['Cache-Control'] = f'private, max-age={max_age}'
+            headers['ETag'] = f'"{hashlib.sha1(profile.encode("utf8")).hexdigest()[:16]}"'
+            cptools.validate_etags()
         return profile
 
+    def _submitJob(self, kind, **params):
+        """
+        Queue a background synchronization for the connected athlete and return its id.
+
+        :param kind: a key of backend.jobs.JOBS
+        """
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            raise cherrypy.HTTPError(403)
+        job_id = get_job_queue(self.config).submit(athlete_id, kind, self._getOrRefreshToken(), **params)
+        return {"job_id": job_id}
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def updateactivities(self):
         """
-        Ajax query /updateactivities to update the activities database
+        Ajax query /updateactivities to update the activities database in the background
         """
         cherrypy.session[self.DUMMY] = 'MyStravaUpdateActivities'
-        view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken())
-        list_ids = view.update_new_activities(stravaRequest)
-        activities = view.get_activities(list_ids=list_ids)
-        view.close()
-        return activities
+        return self._submitJob('update_activities')
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def updategears(self):
         """
-        Ajax query /updatelocaldb to update the database
+        Ajax query /updatelocaldb to update the gears database in the background
         """
-        view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken())
-        view.update_gears(stravaRequest)
-        gears = view.get_gears()
-        view.close()
-        return gears
+        return self._submitJob('update_gears')
 
     @cherrypy.expose
+    @cherrypy.tools.json_out()
     def rebuildactivities(self):
         """
-        Ajax query /upgradelocaldb to upgrade the database
+        Ajax query /upgradelocaldb to upgrade the database in the background. The
+        diff report is the message of the finished job.
         """
-        view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken())
-        view.rebuild_activities(stravaRequest)
-        view.close()
+        return self._submitJob('rebuild_activities')
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def jobstatus(self, job_id):
+        """
+        Ajax query /jobstatus to get the progress of a background job
+        """
+        cherrypy.session[self.DUMMY] = 'MyStravaJobStatus'
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        try:
+            job = get_job_queue(self.config).get(int(job_id), athlete_id)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid job id")
+        if job is None:
+            raise cherrypy.HTTPError(404)
+        cherrypy.response.headers['Cache-Control'] = 'no-store'
+        return job
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def canceljob(self, job_id):
+        """
+        Ajax query /canceljob to stop a background job
+        """
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        try:
+            job = get_job_queue(self.config).cancel(int(job_id), athlete_id)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid job id")
+        if job is None:
+            raise cherrypy.HTTPError(404)
+        return job
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -180,7 +436,7 @@ class StravaUI:
         """
         cherrypy.session[self.DUMMY] = 'MyStravaUpdateActivity'
         view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken())
+        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken(), athlete_id=cherrypy.session.get(self.ATHLETE_ID))
         if isinstance(activity_id, str):
             activity_id = int(activity_id)
         try:
@@ -203,7 +459,7 @@ class StravaUI:
         """
         cherrypy.session[self.DUMMY] = 'MyStravaSetCommute'
         view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken())
+        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken(), athlete_id=cherrypy.session.get(self.ATHLETE_ID))
         if isinstance(activity_id, str):
             activity_id = int(activity_id)
         try:
@@ -230,6 +486,50 @@ class StravaUI:
         cherrypy.response.headers["Content-Type"] = "text/html"
         return "Activity deleted"
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def webhook(self, **params):
+        """
+        Strava webhook callback, see webhook.py to create the subscription.
+
+        GET answers the validation request of the subscription. POST receives an
+        event about an activity or an athlete and queues it, Strava expects an
+        answer within 2 seconds.
+        """
+        verify_token = self.config['webhook_verify_token']
+        if verify_token is None:
+            raise cherrypy.HTTPError(404)
+        method = cherrypy.request.method
+        if method == 'GET':
+            if params.get('hub.mode') != 'subscribe' or params.get('hub.verify_token') != verify_token:
+                raise cherrypy.HTTPError(403)
+            return {'hub.challenge': params.get('hub.challenge')}
+        if method != 'POST':
+            raise cherrypy.HTTPError(405)
+        try:
+            event = json.loads(cherrypy.request.body.read())
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid JSON")
+        # Only Strava knows the id of the subscription
+        subscription_id = self.config['webhook_subscription_id']
+        if subscription_id is None or event.get('subscription_id') != subscription_id:
+            raise cherrypy.HTTPError(403)
+        if not get_event_queue(self.config).push(event):
+            print(f"Ignoring webhook event {event}")
+        return {}
+
+    @cherrypy.expose
+    def metrics(self):
+        """
+        The metrics of the server in the Prometheus text format, see backend.metrics.
+        Disabled unless `metrics` is set in the [server] section.
+        """
+        if not self.config['metrics']:
+            raise cherrypy.HTTPError(404)
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        cherrypy.response.headers['Cache-Control'] = 'no-store'
+        return REGISTRY.render().encode('utf8')
+
     @cherrypy.expose
     def connect(self):
         """
@@ -238,7 +538,7 @@ class StravaUI:
         # Keep session alive
         print(f"Connect - Session ID : {cherrypy.session.id}")
         cherrypy.session[self.DUMMY] = 'MyStravaConnect'
-        client = stravalib.Client()
+        client = stravalib.Client(requests_session=get_requests_session(self.config))
         redirect_url = cherrypy.url(path='/authorized', script_name='')
         #print(redirect_url)
         access_scope=["read_all", "activity:read_all", "profile:read_all"]
@@ -275,7 +575,7 @@ class StravaUI:
         print(f"authorization - {cherrypy.session.id}")
         # Keep session alive
         cherrypy.session[self.DUMMY] = 'MyStravaAuthorized'
-        client = stravalib.Client()
+        client = stravalib.Client(requests_session=get_requests_session(self.config))
         auth_response = client.exchange_code_for_token(client_id=self.config['client_id'], client_secret=self.config['client_secret'], code=code)
         token = auth_response['access_token']
         refresh_token = auth_response['refresh_token']
@@ -285,10 +585,12 @@ class StravaUI:
         cherrypy.session[self.REFRESH_TOKEN] = refresh_token
         cherrypy.session[self.EXPIRES_AT] = expires_at
 
-        client = stravalib.Client(access_token=token)
+        client = stravalib.Client(access_token=token, requests_session=get_requests_session(self.config))
         athlete = client.get_athlete()
+        get_athlete_cache(self.config).put(athlete)
         cherrypy.session[self.ATHLETE_ID] = athlete.id
         cherrypy.session[self.ATHLETE_IS_PREMIUM] = athlete.premium
+        self._saveTokens()
 
         print("-------")
         print(f"athlete: {cherrypy.session.get(self.ATHLETE_ID)}")
@@ -302,7 +604,26 @@ class StravaUI:
         raise cherrypy.HTTPRedirect(cherrypy.url(path='/', script_name=''))
 
     @cherrypy.expose
-    def updatesporttype(self,trail_seuil):
-        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken())
-        view = StravaView(self.config, cherrypy.session.get(self.ATHLETE_ID))
-        view.fix_sport_type_all_activities(stravaRequest, trail_seuil)
+    @cherrypy.tools.json_out()
+    def updatesporttype(self, trail_seuil, dry_run='0'):
+        """
+        Ajax query /updatesporttype to set the sport type of all the activities in the background.
+        With dry_run=1, return at once the number of activities each rule would change, reading
+        the sport types from Strava without writing anything.
+        """
+        try:
+            trail_threshold = int(trail_seuil)
+            dry_run = bool(int(dry_run))
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid threshold or dry_run")
+        if not dry_run:
+            return self._submitJob('update_sport_type', trail_threshold=trail_threshold)
+        athlete_id = cherrypy.session.get(self.ATHLETE_ID)
+        if athlete_id is None or not self.isAuthorized(athlete_id):
+            raise cherrypy.HTTPError(403)
+        stravaRequest = StravaRequest(self.config, self._getOrRefreshToken(), athlete_id=athlete_id)
+        view = StravaView(self.config, athlete_id)
+        try:
+            return view.fix_sport_type_all_activities(stravaRequest, trail_threshold, dry_run=True)
+        finally:
+            view.close()
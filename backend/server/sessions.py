@@ -0,0 +1,231 @@
+import datetime
+import os
+import pickle
+import sqlite3
+import threading
+
+import cherrypy
+from cherrypy.lib.sessions import FileSession, Session
+
+
+class _CoalescingSession(Session):
+    """
+    A session which is only written when its data changed, or when its expiry
+    moved by more than `touch_resolution` seconds. The value of `keepalive_key`,
+    written by the handlers to keep the session alive, is not compared.
+    """
+    keepalive_key = None
+    # Seconds an expiry may lag behind before it is written again
+    touch_resolution = 600
+
+    def __init__(self, id=None, **kwargs):
+        # Data and expiry as loaded, see _is_modified
+        self._loaded = None
+        self._loaded_expiry = None
+        Session.__init__(self, id=id, **kwargs)
+
+    def _payload(self, data):
+        return pickle.dumps({key: value for key, value in data.items() if key != self.keepalive_key},
+                            pickle.HIGHEST_PROTOCOL)
+
+    def _remember(self, data, expiration_time):
+        self._loaded = self._payload(data)
+        self._loaded_expiry = expiration_time
+
+    def _is_modified(self, expiration_time):
+        """
+        Return 'data' if the data changed since it was loaded, 'expiry' if only
+        the expiry must be refreshed and None if there is nothing to write.
+        """
+        if self._loaded is None or self._payload(self._data) != self._loaded:
+            return 'data'
+        if expiration_time - self._loaded_expiry > datetime.timedelta(seconds=self.touch_resolution):
+            return 'expiry'
+        return None
+
+    # One lock per session id, the server runs in a single process
+    def acquire_lock(self):
+        self.locked = True
+        self.locks.setdefault(self.id, threading.RLock()).acquire()
+
+    def release_lock(self):
+        self.locks[self.id].release()
+        self.locked = False
+
+    def _clean_locks(self, live_ids):
+        for session_id in list(self.locks):
+            if session_id not in live_ids and self.locks[session_id].acquire(blocking=False):
+                self.locks.pop(session_id).release()
+
+
+class MemorySession(_CoalescingSession):
+    """
+    Sessions kept in memory and saved to `storage_path/sessions.pickle` every
+    `snapshot_interval` seconds if any of them changed, and when the server
+    stops. A request never touches the disk.
+    """
+    cache = {}
+    locks = {}
+    snapshot_interval = 60
+    snapshot_thread = None
+    _changed = False
+    _setup_lock = threading.Lock()
+
+    @classmethod
+    def _snapshot_path(cls, storage_path):
+        return os.path.join(os.path.abspath(storage_path), 'sessions.pickle')
+
+    def _start(self):
+        """
+        Load the last snapshot and start the snapshot thread, once per process
+        """
+        cls = MemorySession
+        if cls.snapshot_thread is not None:
+            return
+        with cls._setup_lock:
+            if cls.snapshot_thread is not None:
+                return
+            path = self._snapshot_path(self.storage_path)
+            try:
+                with open(path, 'rb') as f:
+                    cls.cache.update(pickle.load(f))
+                print(f"Loaded {len(cls.cache)} sessions from {path}.")
+            except FileNotFoundError:
+                pass
+            except (pickle.UnpicklingError, EOFError, ValueError) as e:
+                print(f"Ignoring the session snapshot {path}: {e}")
+            thread = cherrypy.process.plugins.Monitor(cherrypy.engine, lambda: cls.snapshot(path),
+                                                      self.snapshot_interval, name='Session snapshot')
+            thread.subscribe()
+            # Save the last changes before the server exits
+            cherrypy.engine.subscribe('stop', lambda: cls.snapshot(path), priority=90)
+            cls.snapshot_thread = thread
+            thread.start()
+
+    @classmethod
+    def snapshot(cls, path):
+        """
+        Write the sessions to `path` if any of them changed since the last snapshot
+        """
+        if not cls._changed:
+            return
+        cls._changed = False
+        # The cached dictionaries are replaced by _save, never modified
+        sessions = dict(cls.cache)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(sessions, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def clean_up(self):
+        """Remove the expired sessions"""
+        now = self.now()
+        for session_id, (_, expiration_time) in list(self.cache.items()):
+            if expiration_time <= now:
+                self.cache.pop(session_id, None)
+                MemorySession._changed = True
+        self._clean_locks(self.cache)
+
+    def _exists(self):
+        self._start()
+        return self.id in self.cache
+
+    def _load(self):
+        self._start()
+        stored = self.cache.get(self.id)
+        if stored is None:
+            return None
+        data, expiration_time = stored
+        self._remember(data, expiration_time)
+        return dict(data), expiration_time
+
+    def _save(self, expiration_time):
+        modified = self._is_modified(expiration_time)
+        if modified is None:
+            return
+        stored = self.cache.get(self.id)
+        if modified == 'data' or stored is None:
+            # Also when clean_up removed the session since it was loaded
+            self.cache[self.id] = (dict(self._data), expiration_time)
+        else:
+            self.cache[self.id] = (stored[0], expiration_time)
+        MemorySession._changed = True
+
+    def _delete(self):
+        if self.cache.pop(self.id, None) is not None:
+            MemorySession._changed = True
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class SqliteSession(_CoalescingSession):
+    """
+    Sessions stored in the SQLite database `storage_path/sessions.db`. An
+    unchanged session is not written, a session whose expiry only needs to
+    be refreshed gets a single UPDATE of its expiry.
+    """
+    locks = {}
+    _local = threading.local()
+
+    def _connection(self):
+        """
+        Return the connection of the current thread, creating the table the first time
+        """
+        path = os.path.join(os.path.abspath(self.storage_path), 'sessions.db')
+        connections = self._local.__dict__.setdefault('connections', {})
+        connection = connections.get(path)
+        if connection is None:
+            connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions '
+                               '(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)')
+            connections[path] = connection
+        return connection
+
+    def clean_up(self):
+        """Remove the expired sessions"""
+        connection = self._connection()
+        connection.execute('DELETE FROM sessions WHERE expires <= ?', (self.now().timestamp(),))
+        live_ids = {row[0] for row in connection.execute('SELECT id FROM sessions')}
+        self._clean_locks(live_ids)
+
+    def _exists(self):
+        return self._connection().execute('SELECT 1 FROM sessions WHERE id = ?', (self.id,)).fetchone() is not None
+
+    def _load(self):
+        row = self._connection().execute('SELECT data, expires FROM sessions WHERE id = ?', (self.id,)).fetchone()
+        if row is None:
+            return None
+        data = pickle.loads(row[0])
+        expiration_time = datetime.datetime.fromtimestamp(row[1])
+        self._remember(data, expiration_time)
+        return data, expiration_time
+
+    def _save(self, expiration_time):
+        modified = self._is_modified(expiration_time)
+        if modified is None:
+            return
+        connection = self._connection()
+        if modified == 'expiry':
+            updated = connection.execute('UPDATE sessions SET expires = ? WHERE id = ?',
+                                         (expiration_time.timestamp(), self.id)).rowcount
+            if updated:
+                return
+        # Also when clean_up removed the session since it was loaded
+        connection.execute('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+                           (self.id, pickle.dumps(self._data, pickle.HIGHEST_PROTOCOL), expiration_time.timestamp()))
+
+    def _delete(self):
+        self._connection().execute('DELETE FROM sessions WHERE id = ?', (self.id,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+SESSION_STORES = {
+    'file': FileSession,
+    'memory': MemorySession,
+    'sqlite': SqliteSession,
+}
@@ -0,0 +1,204 @@
+import gzip
+import mimetypes
+import os
+import re
+import time
+import urllib.parse
+import cherrypy
+from cherrypy.lib import static
+from backend.db import remove_session
+from backend import profiling
+from backend.metrics import HTTP_DURATION, HTTP_REQUESTS, reset_method
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files whose name contains a content hash, see buildassets.py
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{12}\.[a-z0-9]+$')
+ONE_YEAR = 365 * 24 * 3600
+
+
+def accepted_encodings():
+    """
+    Return the content codings accepted by the client
+    """
+    return [e.value for e in cherrypy.request.headers.elements('Accept-Encoding') if e.qvalue > 0]
+
+
+def _vary_on_encoding():
+    response = cherrypy.response
+    vary = response.headers.get('Vary')
+    if vary is None:
+        response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = vary + ', Accept-Encoding'
+
+
+def compress(mime_types=('application/json',), threshold=1024, level=6):
+    """
+    Compress the response body with brotli or gzip, depending on what the
+    client accepts, if it is at least `threshold` bytes long.
+
+    :param mime_types: the content types to compress
+
+    :param threshold: the minimum size of the body to compress
+
+    :param level: the gzip compression level
+    """
+    response = cherrypy.response
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type not in mime_types or 'Content-Encoding' in response.headers:
+        return
+    _vary_on_encoding()
+    # The status is only set when finalizing, None means 200.
+    if response.stream or (response.status is not None and not str(response.status).startswith('200')):
+        return
+    body = response.collapse_body()
+    if len(body) < threshold:
+        return
+    encodings = accepted_encodings()
+    if brotli is not None and 'br' in encodings:
+        response.body = brotli.compress(body, quality=5)
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings:
+        response.body = gzip.compress(body, compresslevel=level)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return
+    # Let finalize compute the new length
+    response.headers.pop('Content-Length', None)
+
+
+def precompressed(root, section):
+    """
+    Serve the static files of `root` mounted on `section`, using the .br or .gz
+    variant built by buildassets.py when the client accepts it. Files with a
+    content hash in their name are cached for a year.
+
+    :param root: the directory holding the files
+
+    :param section: the url path where `root` is mounted
+    """
+    request = cherrypy.request
+    relative = request.path_info[len(section):].lstrip('/')
+    path = os.path.normpath(os.path.join(root, relative))
+    if not path.startswith(os.path.normpath(root) + os.sep) or not os.path.isfile(path):
+        return
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encodings = accepted_encodings()
+    served = path
+    encoding = None
+    for name, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if name in encodings and os.path.isfile(path + suffix):
+            served = path + suffix
+            encoding = name
+            break
+    static.serve_file(served, content_type=content_type)
+    headers = cherrypy.response.headers
+    headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    if FINGERPRINTED.search(path):
+        headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+    else:
+        headers['Cache-Control'] = 'no-cache'
+    request.handler = None
+
+
+class MetricsTool(cherrypy.Tool):
+    """
+    Time every request and count it by handler and status, see backend.metrics.
+    The handler is the name of the exposed method of StravaUI, `static` for
+    the files served by the static tools.
+    """
+
+    def __init__(self):
+        super().__init__('on_start_resource', self.start, priority=10)
+
+    def _setup(self):
+        super()._setup()
+        hooks = cherrypy.request.hooks
+        # Before the other tools wrap or replace the page handler
+        hooks.attach('before_handler', self.name_handler, priority=5)
+        hooks.attach('on_end_request', self.end)
+
+    @staticmethod
+    def start():
+        request = cherrypy.request
+        request.metrics_start = time.perf_counter()
+        request.metrics_handler = 'other'
+        # The worker thread may have served a streamed response dropped by its client
+        reset_method()
+
+    @staticmethod
+    def name_handler():
+        request = cherrypy.request
+        request.metrics_handler = getattr(getattr(request.handler, 'callable', None), '__name__', 'other')
+
+    @staticmethod
+    def end():
+        request = cherrypy.request
+        start = getattr(request, 'metrics_start', None)
+        if start is None:
+            return
+        handler = 'static' if request.handler is None else request.metrics_handler
+        status = str(cherrypy.response.status or 200).split(' ', 1)[0]
+        HTTP_DURATION.observe(time.perf_counter() - start, handler)
+        HTTP_REQUESTS.inc(handler, status)
+
+
+class ProfilingTool(cherrypy.Tool):
+    """
+    Profile a fraction of the requests, the requests carrying a signed _profile
+    parameter and the requests slower than `threshold` seconds, see
+    backend.profiling. The profiles are written to `directory`.
+    """
+
+    def __init__(self):
+        super().__init__('on_start_resource', self.start, priority=20)
+
+    def _setup(self):
+        super()._setup()
+        hooks = cherrypy.request.hooks
+        hooks.attach('before_handler', self.before_handler, priority=5)
+        hooks.attach('on_end_request', self.end, **self._merged_args())
+
+    @staticmethod
+    def start(sample_rate=0.0, threshold=0.0, secret=None, interval=0.005, **kwargs):  # pylint: disable=unused-argument
+        request = cherrypy.request
+        # The query string is not parsed yet
+        signature = None
+        if profiling.PARAMETER in request.query_string:
+            signature = (urllib.parse.parse_qs(request.query_string).get(profiling.PARAMETER) or [None])[0]
+        request.profile = profiling.start(sample_rate, threshold, secret, signature, request.path_info, interval)
+        request.profile_handler = 'other'
+
+    @staticmethod
+    def before_handler():
+        request = cherrypy.request
+        request.params.pop(profiling.PARAMETER, None)
+        request.profile_handler = getattr(getattr(request.handler, 'callable', None), '__name__', 'other')
+
+    @staticmethod
+    def end(directory, threshold=0.0, max_files=100, **kwargs):  # pylint: disable=unused-argument
+        request = cherrypy.request
+        profile = getattr(request, 'profile', None)
+        if profile is None:
+            return
+        request.profile = None
+        duration = profile.stop()
+        if not profile.traced and duration < threshold:
+            return
+        handler = 'static' if request.handler is None else request.profile_handler
+        path = profile.save(directory, handler, duration, max_files)
+        print(f"Profiled {request.path_info} in {duration * 1000:.0f} ms: {path}")
+
+
+# Give the database session of the request thread back to the pool once the request is over.
+cherrypy.tools.dbsession = cherrypy.Tool('on_end_request', remove_session)
+cherrypy.tools.compress = cherrypy.Tool('before_finalize', compress, priority=80)
+cherrypy.tools.precompressed = cherrypy.Tool('before_handler', precompressed, priority=40)
+cherrypy.tools.metrics = MetricsTool()
+cherrypy.tools.profiling = ProfilingTool()
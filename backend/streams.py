@@ -0,0 +1,320 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy
+
+# Streams fetched from Strava. latlng is stored as two columns, lat and lng.
+STREAM_TYPES = ('time', 'latlng', 'altitude', 'heartrate', 'cadence', 'watts', 'velocity_smooth')
+
+# Stored columns: (dtype of the deltas, scale). A value is stored as the integer
+# round(value * scale), which keeps 0.1 m of altitude, 1 mm/s of speed and
+# about 0.1 m of position.
+COLUMNS = {
+    'time': ('<i4', 1),
+    'lat': ('<i4', 1_000_000),
+    'lng': ('<i4', 1_000_000),
+    'altitude': ('<i4', 10),
+    'heartrate': ('<i2', 1),
+    'cadence': ('<i2', 1),
+    'watts': ('<i2', 1),
+    'velocity_smooth': ('<i4', 1000),
+}
+
+MAGIC = b'MYSTRM1\n'
+HEADER_LENGTH = struct.Struct('<I')
+# Number of samples compressed together. A read only decompresses the blocks
+# of the requested columns and time range.
+BLOCK_SIZE = 4096
+
+
+def _pack(values, dtype, scale):
+    """
+    Quantize, delta encode and compress a block of values. The bytes of the
+    deltas are shuffled, high bytes together, which zlib compresses much better.
+    """
+    quantized = numpy.rint(numpy.asarray(values, dtype=numpy.float64) * scale).astype(numpy.int64)
+    deltas = numpy.diff(quantized, prepend=0).astype(dtype)
+    shuffled = deltas.view(numpy.uint8).reshape(-1, deltas.itemsize).T
+    return zlib.compress(shuffled.tobytes(), 6)
+
+
+def _unpack(data, dtype, count):
+    """
+    Reverse _pack, without the scale
+    """
+    itemsize = numpy.dtype(dtype).itemsize
+    shuffled = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8).reshape(itemsize, count)
+    deltas = numpy.ascontiguousarray(shuffled.T).view(dtype).ravel()
+    return numpy.cumsum(deltas, dtype=numpy.int64)
+
+
+def to_columns(streams):
+    """
+    Return the columns to store from the streams of an activity
+
+    :param streams: a dictionary {type: stravalib.model.Stream} as returned by
+    stravalib.Client.get_activity_streams, or {type: list of values}
+    """
+    columns = {}
+    for name, stream in streams.items():
+        data = getattr(stream, 'data', stream)
+        if name not in STREAM_TYPES or not data:
+            continue
+        if name == 'latlng':
+            latlng = numpy.array([point if point else (0, 0) for point in data], dtype=numpy.float64).reshape(-1, 2)
+            columns['lat'] = latlng[:, 0]
+            columns['lng'] = latlng[:, 1]
+        else:
+            columns[name] = numpy.array([0 if value is None else value for value in data], dtype=numpy.float64)
+    if 'time' not in columns:
+        return {}
+    length = len(columns['time'])
+    return {name: values for name, values in columns.items() if len(values) == length}
+
+
+def write_stream_file(path, columns):
+    """
+    Write the columns of an activity to `path`, atomically.
+
+    The file starts with MAGIC and a JSON header giving, for every column, its
+    dtype, scale and the (offset, size) of its compressed blocks, followed by
+    the blocks. The header also lists the time at the start of every block.
+
+    :param path: the file to write
+
+    :param columns: a dictionary {name: array of values} as returned by to_columns
+    """
+    length = len(columns['time'])
+    header = {'length': length, 'block_size': BLOCK_SIZE, 'columns': {},
+              'starts': [float(t) for t in columns['time'][::BLOCK_SIZE]]}
+    blocks = []
+    offset = 0
+    for name, values in columns.items():
+        dtype, scale = COLUMNS[name]
+        index = []
+        for start in range(0, length, BLOCK_SIZE):
+            data = _pack(values[start:start + BLOCK_SIZE], dtype, scale)
+            index.append((offset, len(data)))
+            blocks.append(data)
+            offset += len(data)
+        header['columns'][name] = {'dtype': dtype, 'scale': scale, 'blocks': index}
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf8')
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(encoded)))
+        f.write(encoded)
+        for data in blocks:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class StreamFile:
+    """
+    A stream file opened with mmap. Only the blocks of the columns read are
+    decompressed, the rest of the file is never loaded.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a stream file")
+        start = len(MAGIC) + HEADER_LENGTH.size
+        (size,) = HEADER_LENGTH.unpack_from(self.mmap, len(MAGIC))
+        header = json.loads(self.mmap[start:start + size])
+        self.data_offset = start + size
+        self.length = header['length']
+        self.block_size = header['block_size']
+        self.columns = header['columns']
+        self.starts = numpy.array(header['starts'], dtype=numpy.float64)
+
+    def close(self):
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def block_range(self, start=None, end=None):
+        """
+        Return the range of blocks holding the samples between the times `start` and `end`
+        """
+        first = 0 if start is None else max(0, int(numpy.searchsorted(self.starts, start, side='right')) - 1)
+        last = len(self.starts) if end is None else int(numpy.searchsorted(self.starts, end, side='right'))
+        return range(first, max(first, last))
+
+    def read(self, name, blocks=None):
+        """
+        Return the values of a column as float64, in its unit
+
+        :param name: a column name, see COLUMNS
+
+        :param blocks: a range of blocks as returned by block_range. Default to all of them.
+        """
+        column = self.columns[name]
+        if blocks is None:
+            blocks = range(len(column['blocks']))
+        parts = []
+        for block in blocks:
+            offset, size = column['blocks'][block]
+            count = min(self.block_size, self.length - block * self.block_size)
+            start = self.data_offset + offset
+            parts.append(_unpack(self.mmap[start:start + size], column['dtype'], count))
+        if not parts:
+            return numpy.zeros(0)
+        return numpy.concatenate(parts) / column['scale']
+
+
+class StreamStore:
+    """
+    The stream files of an athlete, one per activity in `root/<athlete_id>/`.
+    """
+
+    SUFFIX = '.strm'
+
+    def __init__(self, root, athlete_id):
+        self.directory = os.path.join(root, str(athlete_id))
+
+    def path(self, activity_id):
+        return os.path.join(self.directory, f"{activity_id}{self.SUFFIX}")
+
+    def exists(self, activity_id):
+        return os.path.exists(self.path(activity_id))
+
+    def write(self, activity_id, columns):
+        """
+        Store the columns of an activity. Return False if there is nothing to
+        store, e.g. for a manual activity.
+
+        :param activity_id: the id of the activity
+
+        :param columns: the columns as returned by to_columns
+        """
+        if not columns:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        write_stream_file(self.path(activity_id), columns)
+        return True
+
+    def activity_ids(self):
+        """
+        Return the ids of the activities with stored streams
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [int(name[:-len(self.SUFFIX)]) for name in names if name.endswith(self.SUFFIX)]
+
+    def open(self, activity_id):
+        """
+        Return the StreamFile of an activity, None if its streams were never fetched
+        """
+        try:
+            return StreamFile(self.path(activity_id))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, activity_ids):
+        for activity_id in activity_ids:
+            try:
+                os.remove(self.path(activity_id))
+            except FileNotFoundError:
+                pass
+
+
+def lttb(x, y, threshold):
+    """
+    Return the indices of the points kept by the Largest-Triangle-Three-Buckets
+    downsampling of (x, y) to `threshold` points. The first and last points are
+    always kept. In every bucket, the point kept makes the largest triangle with
+    the point kept in the previous bucket and the mean of the next bucket.
+
+    :param x: the increasing abscissas
+
+    :param y: the values
+
+    :param threshold: the number of points to keep
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+    # Bucket boundaries of the n - 2 inner points
+    edges = numpy.floor(numpy.linspace(1, n - 1, threshold - 1)).astype(numpy.int64)
+    x_sums = numpy.concatenate(([0.0], numpy.cumsum(x)))
+    y_sums = numpy.concatenate(([0.0], numpy.cumsum(y)))
+    indices = numpy.empty(threshold, dtype=numpy.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_lo, next_hi = hi, edges[bucket + 2]
+            count = next_hi - next_lo
+            mean_x = (x_sums[next_hi] - x_sums[next_lo]) / count
+            mean_y = (y_sums[next_hi] - y_sums[next_lo]) / count
+        else:
+            mean_x, mean_y = x[n - 1], y[n - 1]
+        ax, ay = x[previous], y[previous]
+        areas = numpy.abs((ax - mean_x) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (mean_y - ay))
+        previous = lo + int(numpy.argmax(areas))
+        indices[bucket + 1] = previous
+    return indices
+
+
+def downsample(stream_file: StreamFile, names, points, start=None, end=None):
+    """
+    Return the streams of an activity reduced to at most `points` points, as
+    {name: {"time": [...], "data": [...]}}. Every stream is reduced with lttb
+    against the time, except latlng which has two values per point and is
+    decimated evenly. Only the blocks of the requested streams and time range
+    are read.
+
+    :param stream_file: a StreamFile
+
+    :param names: the streams, see STREAM_TYPES
+
+    :param points: the maximum number of points of every stream
+
+    :param start: the first second to return, default to the start of the activity
+
+    :param end: the last second to return, default to the end of the activity
+    """
+    blocks = stream_file.block_range(start, end)
+    time = stream_file.read('time', blocks)
+    mask = numpy.ones(len(time), dtype=bool)
+    if start is not None:
+        mask &= time >= start
+    if end is not None:
+        mask &= time <= end
+    time = time[mask]
+    result = {}
+    for name in names:
+        if name == 'latlng':
+            if 'lat' not in stream_file.columns:
+                continue
+            lat = stream_file.read('lat', blocks)[mask]
+            lng = stream_file.read('lng', blocks)[mask]
+            keep = numpy.unique(numpy.linspace(0, len(time) - 1, min(points, len(time))).astype(numpy.int64)) \
+                if len(time) else numpy.zeros(0, dtype=numpy.int64)
+            data = numpy.stack((lat[keep], lng[keep]), axis=1).tolist()
+        else:
+            if name not in stream_file.columns or name == 'time':
+                continue
+            values = stream_file.read(name, blocks)[mask]
+            keep = lttb(time, values, points)
+            data = values[keep].tolist()
+        result[name] = {'time': time[keep].astype(numpy.int64).tolist(), 'data': data}
+    return result
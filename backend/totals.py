@@ -0,0 +1,106 @@
+from datetime import timedelta
+
+import sqlalchemy
+
+from backend.db import upsert
+from backend.models import Activity, ActivityTotal
+from backend.utils import duration_seconds
+
+PERIODS = ('year', 'month', 'week')
+# Columns of the activities table needed to compute the totals
+TOTALS_FIELDS = ('athlete', 'sport_type', 'gear_id', 'date', 'distance', 'elevation', 'moving_time')
+KEY_COLUMNS = ('athlete', 'sport_type', 'gear_id', 'period', 'start')
+VALUE_COLUMNS = ('distance', 'elevation', 'moving_time', 'count')
+
+
+def period_starts(date):
+    """
+    Return the (period, first day) pairs of the periods containing `date`.
+    Weeks start on Monday.
+    """
+    day = date.date() if hasattr(date, 'date') else date
+    return (('year', day.replace(month=1, day=1)),
+            ('month', day.replace(day=1)),
+            ('week', day - timedelta(days=day.weekday())))
+
+
+class TotalsDelta:
+    """
+    Accumulate the changes of the activity totals caused by a set of writes to
+    the activities table, then apply them with one upsert and one DELETE.
+    """
+
+    def __init__(self):
+        self.deltas = {}
+
+    def _add(self, row, sign):
+        value = row if isinstance(row, dict) else {field: getattr(row, field) for field in TOTALS_FIELDS}
+        if value['date'] is None:
+            return
+        sport_type = value['sport_type'] or ''
+        gear_id = value['gear_id'] or ''
+        amounts = (sign * (value['distance'] or 0), sign * (value['elevation'] or 0),
+                   sign * duration_seconds(value['moving_time']), sign)
+        for period, start in period_starts(value['date']):
+            key = (value['athlete'], sport_type, gear_id, period, start)
+            current = self.deltas.get(key, (0, 0, 0, 0))
+            self.deltas[key] = tuple(a + b for a, b in zip(current, amounts))
+
+    def add(self, row):
+        """
+        Count an activity in the totals
+
+        :param row: an Activity or a dictionary with the TOTALS_FIELDS keys
+        """
+        self._add(row, 1)
+
+    def remove(self, row):
+        """
+        Remove an activity from the totals
+
+        :param row: an Activity or a dictionary with the TOTALS_FIELDS keys
+        """
+        self._add(row, -1)
+
+    def apply(self, session: sqlalchemy.orm.Session, chunk_size=500):
+        """
+        Write the accumulated changes by chunks of `chunk_size` totals. The session is not committed.
+        """
+        deltas = [(key, delta) for key, delta in self.deltas.items() if any(delta)]
+        self.deltas = {}
+        for i in range(0, len(deltas), chunk_size):
+            self._apply_chunk(session, dict(deltas[i:i + chunk_size]))
+
+    @staticmethod
+    def _apply_chunk(session, deltas):
+        """
+        Add the deltas to the totals without reading them first, so that two
+        threads updating the same totals do not lose any change, then remove
+        the totals left without activities.
+        """
+        key_columns = [getattr(ActivityTotal, c) for c in KEY_COLUMNS]
+        rows = []
+        for key, delta in deltas.items():
+            row = dict(zip(KEY_COLUMNS, key))
+            row.update(zip(VALUE_COLUMNS, delta))
+            rows.append(row)
+        upsert(session, ActivityTotal.__table__, rows, list(VALUE_COLUMNS), increment=True)
+        session.query(ActivityTotal).filter(sqlalchemy.tuple_(*key_columns).in_(list(deltas.keys())), ActivityTotal.count <= 0) \
+            .delete(synchronize_session=False)
+
+
+def rebuild_totals(session: sqlalchemy.orm.Session, athlete_id: int):
+    """
+    Recompute the totals of an athlete from the activities table and commit.
+
+    :param session: a database session
+
+    :param athlete_id: the strava id of the athlete
+    """
+    session.query(ActivityTotal).filter(ActivityTotal.athlete == athlete_id).delete(synchronize_session=False)
+    totals = TotalsDelta()
+    columns = [getattr(Activity, field) for field in TOTALS_FIELDS]
+    for row in session.query(*columns).filter(Activity.athlete == athlete_id).yield_per(1000):
+        totals.add(row)
+    totals.apply(session)
+    session.commit()
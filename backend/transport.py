@@ -0,0 +1,120 @@
+import random
+import threading
+import re
+import time
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+from backend.metrics import STRAVA_DURATION, STRAVA_REQUESTS
+from backend.ratelimit import RateLimiter, get_rate_limiter
+
+API_PREFIX = '/api/v3/'
+# Activity, athlete and gear ids in the paths
+ID_PATTERN = re.compile(r'/(\d+|[a-z]\d+)(?=/|$)')
+
+_requests_session = None
+_requests_session_lock = threading.Lock()
+
+
+class StravaSession(requests.Session):
+    """
+    A requests.Session shared by all the stravalib clients of the process. The
+    connections to Strava are pooled and kept alive, at most `concurrency`
+    requests are sent at once and the rate limit headers of every response
+    update the rate limiter. The requests answered by 429 while the quota is
+    not used up, e.g. after a burst, or by a 5xx error for the GET requests are
+    retried after an exponential backoff with jitter.
+
+    The access token is sent as a parameter of every request by stravalib, the
+    session holds no state specific to an athlete.
+    """
+    # Server errors retried, only for the GET requests which are idempotent
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, rate_limiter: RateLimiter, concurrency=8, retries=3, backoff=1.0, max_backoff=60.0):
+        """
+        :param rate_limiter: the RateLimiter to update from the headers
+
+        :param concurrency: the maximum number of requests in flight, also the size of the pool
+
+        :param retries: the number of retries of a failed request
+
+        :param backoff: the base delay in seconds, doubled at every retry
+
+        :param max_backoff: the maximum delay in seconds between two attempts
+        """
+        super().__init__()
+        self.pool_size = concurrency
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.rate_limiter = rate_limiter
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def endpoint(url):
+        """
+        Return the path of `url` with the ids replaced, to label the metrics
+        """
+        path = urlsplit(url).path
+        if path.startswith(API_PREFIX):
+            path = path[len(API_PREFIX) - 1:]
+        return ID_PATTERN.sub('/{id}', path)
+
+    def delay(self, response: requests.Response, attempt):
+        """
+        Return the seconds to wait before retrying: a random delay up to
+        backoff * 2 ** attempt, at least Retry-After if Strava sent one
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        try:
+            delay = max(delay, min(self.max_backoff, float(response.headers.get('Retry-After', 0))))
+        except ValueError:
+            pass
+        return delay
+
+    def request(self, method, url, *args, **kwargs):  # pylint: disable=arguments-differ
+        attempt = 0
+        while True:
+            endpoint = f"{method.upper()} {self.endpoint(url)}"
+            with self.slots:
+                start = time.perf_counter()
+                try:
+                    response = super().request(method, url, *args, **kwargs)
+                except requests.RequestException:
+                    STRAVA_REQUESTS.inc(endpoint, 'error')
+                    raise
+                finally:
+                    STRAVA_DURATION.observe(time.perf_counter() - start, endpoint)
+            STRAVA_REQUESTS.inc(endpoint, str(response.status_code))
+            self.rate_limiter.update(response.headers)
+            status = response.status_code
+            # Retrying is useless once the quota of the window is used up
+            retry = (status == 429 and not self.rate_limiter.exhausted()) or \
+                (status in self.RETRY_STATUSES and method.upper() == 'GET')
+            if not retry or attempt >= self.retries:
+                return response
+            delay = self.delay(response, attempt)
+            print(f"Strava answered {status} to {method} {url.split('?')[0]}, retrying in {delay:.1f}s")
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+def get_requests_session(config):
+    """
+    Return the StravaSession shared by the whole process
+
+    :param config: a dictionary as returned by readconfig.read_config
+    """
+    global _requests_session
+    if _requests_session is None:
+        with _requests_session_lock:
+            if _requests_session is None:
+                _requests_session = StravaSession(get_rate_limiter(config), config['http_concurrency'], config['http_retries'])
+    return _requests_session
@@ -1,8 +1,27 @@
 import ssl
+from time import perf_counter as time_counter
+from datetime import time, timedelta
 import certifi
 from geopy.geocoders import Nominatim, options as geooptions
 from geopy.exc import GeopyError
 
+from backend.metrics import GEOCODER_DURATION
+
+_geolocator = None
+
+
+def get_geolocator():
+    """
+    Return the Nominatim geocoder shared by the whole process
+    """
+    global _geolocator
+    if _geolocator is None:
+        ctx = ssl.create_default_context(cafile=certifi.where())
+        geooptions.default_ssl_context = ctx
+        _geolocator = Nominatim(user_agent="StravaView")
+    return _geolocator
+
+
 def get_location(cords):
     """
     Return the city or village along with the department number corresponding
@@ -15,12 +34,14 @@ def get_location(cords):
         return None
     max_attempts = 4
     attempts = 0
-    ctx = ssl.create_default_context(cafile=certifi.where())
-    geooptions.default_ssl_context = ctx
-    geolocator = Nominatim(user_agent="StravaView")
+    geolocator = get_geolocator()
     while True:
         try:
-            location = geolocator.reverse((cords.lat, cords.lon))
+            start = time_counter()
+            try:
+                location = geolocator.reverse((cords.lat, cords.lon))
+            finally:
+                GEOCODER_DURATION.observe(time_counter() - start)
             if location.raw is None:
                 return None
             location_dict = location.raw['address']
@@ -38,3 +59,18 @@ def get_location(cords):
             if attempts > max_attempts:
                 print(f"Error getting reverse location for {cords.lat},{cords.lon}", e)
                 return ""
+
+
+def duration_seconds(value):
+    """
+    Return a duration stored in a Time column as a number of seconds
+
+    :param value: a datetime.time, a datetime.timedelta or None
+    """
+    if value is None:
+        return 0
+    if isinstance(value, timedelta):
+        return int(value.total_seconds())
+    if isinstance(value, time):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    return int(value)
@@ -0,0 +1,277 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+import stravalib
+import stravalib.exc
+
+from backend.athletes import get_athlete_cache
+from backend.db import Session, get_engine, remove_session, upsert
+from backend.models import Activity, WebhookEvent
+from backend.stravadb import StravaView
+from backend.transport import get_requests_session
+
+_event_queue = None
+_event_queue_lock = threading.Lock()
+
+OBJECT_TYPES = ('activity', 'athlete')
+ASPECT_TYPES = ('create', 'update', 'delete')
+
+
+class EventQueue:
+    """
+    Apply the Strava webhook events to the local db in a background thread.
+
+    The events are stored in the webhook_events table with one row per object,
+    so a burst of events about the same activity is applied once, after `delay`
+    seconds without any new event. A deletion supersedes the previous events,
+    a creation or an update fetches the activity from Strava. An event which
+    cannot be applied is retried with an exponential backoff, and dropped after
+    MAX_ATTEMPTS attempts.
+    """
+    # Maximal number of events applied in one pass
+    BATCH_SIZE = 100
+    # Maximal delay in seconds between two scans of the table when idle
+    IDLE_TIMEOUT = 60
+    # Seconds before the first retry, doubled by every failure up to MAX_BACKOFF
+    BACKOFF = 30
+    MAX_BACKOFF = 3600
+    MAX_ATTEMPTS = 8
+
+    def __init__(self, config, delay):
+        """
+        :param config: a dictionary as returned by readconfig.read_config
+
+        :param delay: the number of seconds to wait for the next events of a burst
+        """
+        self.config = config
+        self.delay = delay
+        get_engine(config)
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name='webhooks', daemon=True)
+        self.thread.start()
+
+    def push(self, event: dict):
+        """
+        Queue a webhook event, replacing the pending event about the same object.
+        Return False if the event is not supported.
+
+        :param event: the JSON body posted by Strava
+        """
+        object_type = event.get('object_type')
+        aspect_type = event.get('aspect_type')
+        if object_type not in OBJECT_TYPES or aspect_type not in ASPECT_TYPES or event.get('object_id') is None:
+            return False
+        session = Session()
+        try:
+            upsert(session, WebhookEvent.__table__, [{
+                'object_type': object_type,
+                'object_id': int(event['object_id']),
+                'owner_id': int(event.get('owner_id') or 0),
+                'aspect_type': aspect_type,
+                'updates': json.dumps(event.get('updates') or {}),
+                'received': datetime.now(),
+                'attempts': 0,
+                'next_attempt': None,
+            }], ['owner_id', 'aspect_type', 'updates', 'received', 'attempts', 'next_attempt'])
+            session.commit()
+        finally:
+            session.close()
+        self.wakeup.set()
+        return True
+
+    def stop(self):
+        """
+        Stop the background thread after the event in progress
+        """
+        self.stop_event.set()
+        self.wakeup.set()
+        self.thread.join()
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            self.wakeup.clear()
+            try:
+                timeout = self.process_events()
+            except Exception as e:
+                print(f"Error applying the webhook events: {e}")
+                timeout = self.delay
+            finally:
+                remove_session()
+            self.wakeup.wait(timeout=self.IDLE_TIMEOUT if timeout is None else max(timeout, 0.1))
+
+    def process_events(self):
+        """
+        Apply the events received at least `delay` seconds ago and due for a
+        retry. Return the number of seconds until the next event is due or None
+        if there is none.
+        """
+        session = Session()
+        now = datetime.now()
+        due = now - timedelta(seconds=self.delay)
+        ready = sqlalchemy.or_(WebhookEvent.next_attempt.is_(None), WebhookEvent.next_attempt <= now)
+        # Plain rows, not refreshed from the db when a newer event replaces them
+        events = session.query(WebhookEvent.object_type, WebhookEvent.object_id, WebhookEvent.owner_id,
+                               WebhookEvent.aspect_type, WebhookEvent.updates, WebhookEvent.received, WebhookEvent.attempts) \
+            .filter(WebhookEvent.received <= due, ready).order_by(WebhookEvent.received).limit(self.BATCH_SIZE).all()
+        by_owner = {}
+        for event in events:
+            by_owner.setdefault(event.owner_id, []).append(event)
+        for owner_id, owner_events in by_owner.items():
+            if self.stop_event.is_set():
+                break
+            try:
+                self._apply(owner_id, owner_events)
+            except Exception as e:
+                print(f"Webhook: error applying the events of athlete {owner_id}: {e}")
+                session.rollback()
+                self._failed(session, owner_events)
+        first_new = session.query(sqlalchemy.func.min(WebhookEvent.received)).filter(WebhookEvent.next_attempt.is_(None)).scalar()
+        first_retry = session.query(sqlalchemy.func.min(WebhookEvent.next_attempt)).scalar()
+        next_times = [t for t in (first_new and first_new + timedelta(seconds=self.delay), first_retry) if t is not None]
+        if not next_times:
+            return None
+        return (min(next_times) - datetime.now()).total_seconds()
+
+    def _failed(self, session, events):
+        """
+        Schedule the next attempt of events which could not be applied, or drop
+        them after MAX_ATTEMPTS attempts. A newer event replacing one of them
+        starts again from the first attempt.
+        """
+        now = datetime.now()
+        for event in events:
+            match = session.query(WebhookEvent).filter(WebhookEvent.object_type == event.object_type, WebhookEvent.object_id == event.object_id,
+                                                       WebhookEvent.received == event.received)
+            attempts = event.attempts + 1
+            if attempts >= self.MAX_ATTEMPTS:
+                print(f"Webhook: dropping the {event.aspect_type} event of {event.object_type} {event.object_id} after {attempts} attempts.")
+                match.delete(synchronize_session=False)
+            else:
+                backoff = min(self.BACKOFF * 2 ** (attempts - 1), self.MAX_BACKOFF)
+                match.update({WebhookEvent.attempts: attempts, WebhookEvent.next_attempt: now + timedelta(seconds=backoff)},
+                             synchronize_session=False)
+        session.commit()
+
+    def _done(self, session, event):
+        # Keep the event if a newer one replaced it in the meantime.
+        session.query(WebhookEvent).filter(WebhookEvent.object_type == event.object_type, WebhookEvent.object_id == event.object_id,
+                                           WebhookEvent.received == event.received).delete(synchronize_session=False)
+
+    def _client(self, view: StravaView):
+        """
+        Return a stravalib.Client for the athlete of `view`, refreshing its token
+        if needed, or None if the athlete never logged in.
+        """
+        tokens = view.get_tokens()
+        if tokens is None:
+            return None
+        if time.time() > tokens.expires_at - 60:
+            http = get_requests_session(self.config)
+            response = stravalib.Client(requests_session=http).refresh_access_token(
+                client_id=self.config['client_id'], client_secret=self.config['client_secret'], refresh_token=tokens.refresh_token)
+            view.save_tokens(response['access_token'], response['refresh_token'], response['expires_at'])
+            get_athlete_cache(self.config).invalidate(view.athlete_id)
+            return stravalib.Client(access_token=response['access_token'], requests_session=http)
+        return stravalib.Client(access_token=tokens.access_token, requests_session=get_requests_session(self.config))
+
+    def _revoked(self, view: StravaView):
+        """
+        Return True if Strava confirms that the athlete of `view` revoked the
+        access of the application, so that a forged event cannot remove its tokens
+        """
+        try:
+            client = self._client(view)
+            if client is None:
+                return True
+            client.get_athlete()
+        except stravalib.exc.Fault as e:
+            # 401 for a revoked access token, 400 for a revoked refresh token
+            if e.response is not None and e.response.status_code in (400, 401):
+                return True
+            raise
+        return False
+
+    def _apply(self, owner_id, events):
+        """
+        Apply the events of an athlete and remove them from the queue. Raise an
+        exception if the remaining events must be retried later.
+        """
+        view = StravaView(self.config, owner_id)
+        session = view.session
+        try:
+            for event in [e for e in events if e.object_type == 'athlete']:
+                updates = json.loads(event.updates or '{}')
+                if str(updates.get('authorized', '')).lower() == 'false':
+                    if not self._revoked(view):
+                        print(f"Webhook: athlete {owner_id} still grants the access, ignoring the deauthorization.")
+                        self._done(session, event)
+                        session.commit()
+                        continue
+                    print(f"Athlete {owner_id} revoked the access, forgetting the tokens.")
+                    view.delete_tokens()
+                    session.query(WebhookEvent).filter(WebhookEvent.owner_id == owner_id).delete(synchronize_session=False)
+                    session.commit()
+                    return
+                # The profile or the gears may have changed
+                get_athlete_cache(self.config).invalidate(owner_id)
+                self._done(session, event)
+            events = [e for e in events if e.object_type == 'activity']
+
+            deleted = [e for e in events if e.aspect_type == 'delete']
+            if deleted:
+                count = view.delete_activities([e.object_id for e in deleted])
+                print(f"Webhook: {count} activities deleted for athlete {owner_id}.")
+                for event in deleted:
+                    self._done(session, event)
+                session.commit()
+
+            fetched = [e for e in events if e.aspect_type != 'delete']
+            if not fetched:
+                session.commit()
+                return
+            client = self._client(view)
+            if client is None:
+                print(f"Webhook: no token for athlete {owner_id}, dropping {len(fetched)} events.")
+                for event in fetched:
+                    self._done(session, event)
+                session.commit()
+                return
+            for event in fetched:
+                if not view.rate_limiter.acquire(self.stop_event):
+                    return
+                try:
+                    activity = client.get_activity(event.object_id)
+                except stravalib.exc.ObjectNotFound:
+                    # Deleted or made inaccessible since the event was sent, only removed if it belongs to the athlete.
+                    view.delete_activities([event.object_id])
+                    activity = None
+                if activity is not None and (activity.athlete is None or activity.athlete.id != owner_id):
+                    print(f"Webhook: activity {event.object_id} does not belong to athlete {owner_id}, ignoring the event.")
+                    activity = None
+                if activity is not None:
+                    if session.query(Activity.id).filter(Activity.id == activity.id).first() is None:
+                        view.push_activity(activity)
+                    else:
+                        view.update_activity(activity)
+                self._done(session, event)
+                session.commit()
+        finally:
+            view.close()
+
+
+def get_event_queue(config):
+    """
+    Return the webhook event queue shared by the whole process, starting its thread on first use.
+
+    :param config: a dictionary as returned by readconfig.read_config
+    """
+    global _event_queue
+    if _event_queue is None:
+        with _event_queue_lock:
+            if _event_queue is None:
+                _event_queue = EventQueue(config, config['webhook_delay'])
+    return _event_queue
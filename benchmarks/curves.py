@@ -0,0 +1,83 @@
+import numpy
+
+from backend import curves
+from backend.stravadb import StravaView
+from benchmarks import synthetic
+from benchmarks.timing import measure, per_second
+
+
+def naive_mean_max(grid, durations=curves.DURATIONS):
+    """
+    The best average of `grid` for every duration with a running sum in pure Python
+    """
+    values = [float(value) for value in grid]
+    curve = []
+    for duration in durations:
+        if duration > len(values):
+            curve.append(float('nan'))
+            continue
+        window = sum(values[:duration])
+        best = window
+        for i in range(duration, len(values)):
+            window += values[i] - values[i - duration]
+            if window > best:
+                best = window
+        curve.append(best / duration)
+    return numpy.array(curve)
+
+
+def _read_curves(view, activity_id):
+    with view.streams.open(activity_id) as stream_file:
+        return curves.activity_curves(lambda name: stream_file.read(name) if name in stream_file.columns else None)
+
+
+def run(config, athletes, repeat=10):
+    """
+    Measure the duration curves on the streams of the first synthetic athlete:
+    one activity with a naive and the vectorised implementation, all the
+    activities, and the period curves rebuilt or merged with one new activity.
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athletes: the list of loaded SyntheticAthlete
+
+    :param repeat: the number of measured calls of each method
+    """
+    athlete = athletes[0]
+    view = StravaView(config, athlete.id)
+    try:
+        synthetic.load_streams(view, athlete)
+        rides = [a for a in athlete.activities if a['type'] == 'Ride']
+        longest = max(rides, key=lambda a: a['moving_time'])
+        with view.streams.open(longest['id']) as stream_file:
+            grid = curves.per_second(stream_file.read('time'), stream_file.read('watts'))
+        naive = measure(lambda: naive_mean_max(grid), max(1, repeat // 10), warmup=0)
+        vectorised = measure(lambda: curves.mean_max(grid), repeat)
+        same = bool(numpy.allclose(naive_mean_max(grid), curves.mean_max(grid), equal_nan=True))
+        activities = len(view.streams.activity_ids())
+        compute_all = measure(view.compute_curves, min(3, repeat), warmup=1)
+        compute_all['activities_per_second'] = per_second(compute_all, activities)
+
+        def rebuild():
+            curves.rebuild_period_curves(view.session, athlete.id)
+            view.session.commit()
+
+        latest = {longest['id']: _read_curves(view, longest['id'])}
+
+        def add_one():
+            view.save_curves(latest)
+            view.session.commit()
+
+        return {
+            "samples": len(grid),
+            "activity_naive": naive,
+            "activity_vectorised": vectorised,
+            "same_curves": same,
+            "compute_all": compute_all,
+            "period_rebuild": measure(rebuild, repeat),
+            "period_add_one": measure(add_one, repeat),
+            "get_curves_year": measure(lambda: view.get_curves('watts', 'year'), repeat),
+            "get_curves_season": measure(lambda: view.get_curves('speed', 'season'), repeat),
+        }
+    finally:
+        view.close()
@@ -0,0 +1,129 @@
+import os
+import socket
+import threading
+import time
+
+import cherrypy
+import requests
+
+from backend import app_dir
+from backend.server import app_config
+from backend.server.serve import StravaUI
+from benchmarks.fakestrava import token
+from benchmarks.timing import measure, percentile
+
+
+class _BenchUI(StravaUI):
+    """
+    The application with a way to open a session without going through Strava
+    """
+
+    @cherrypy.expose
+    def benchlogin(self, athlete):
+        cherrypy.session[self.ATHLETE_ID] = int(athlete)
+        cherrypy.session[self.ACCESS_TOKEN] = token(athlete)
+        cherrypy.session[self.REFRESH_TOKEN] = token(athlete)
+        cherrypy.session[self.EXPIRES_AT] = time.time() + 24 * 3600
+        return "ok"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start(config):
+    port = _free_port()
+    frontend_dir = os.path.join(app_dir, 'frontend')
+    conf = app_config(frontend_dir)
+    conf['/']['log.access_file'] = ''
+    conf['/']['log.error_file'] = ''
+    cherrypy.config.update({'server.socket_host': '127.0.0.1', 'server.socket_port': port,
+                            'log.screen': False, 'engine.autoreload.on': False, 'checker.on': False})
+    cherrypy.tree.mount(_BenchUI(frontend_dir, config), '/', conf)
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+    return f"http://127.0.0.1:{port}"
+
+
+def _stop():
+    cherrypy.engine.exit()
+    # Bind a new port the next time, e.g. for another database
+    cherrypy.server.httpserver = None
+
+
+def _throughput(url, sessions, path, params, concurrency, requests_per_thread):
+    """
+    Send requests from `concurrency` threads at once and return the requests per second and the latencies
+    """
+    samples = []
+    lock = threading.Lock()
+
+    def worker(rank):
+        http = sessions[rank % len(sessions)]
+        local = []
+        for _ in range(requests_per_thread):
+            start = time.perf_counter()
+            http.get(url + path, params=params).raise_for_status()
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(rank,)) for rank in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "requests_per_second": round(len(samples) / elapsed, 1),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+    }
+
+
+def run(config, athletes, repeat=50, concurrency=4):
+    """
+    Measure the read endpoints of StravaUI over HTTP, with the synthetic
+    athletes already loaded in the db.
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athletes: the list of loaded SyntheticAthlete
+
+    :param repeat: the number of measured requests of each endpoint
+
+    :param concurrency: the number of clients sending requests at once for the throughput
+    """
+    url = _start(config)
+    try:
+        sessions = []
+        for athlete in athletes:
+            http = requests.Session()
+            http.get(url + '/benchlogin', params={'athlete': athlete.id}).raise_for_status()
+            sessions.append(http)
+        http = sessions[0]
+        etag = http.get(url + '/getRuns').headers['ETag']
+
+        def get(path, params=None, headers=None):
+            return lambda: http.get(url + path, params=params, headers=headers).raise_for_status()
+
+        results = {
+            "getRuns": measure(get('/getRuns'), repeat),
+            "getRuns_page": measure(get('/getRuns', {'limit': 500}), repeat),
+            "getRuns_not_modified": measure(get('/getRuns', headers={'If-None-Match': etag}), repeat),
+            "streamRuns": measure(get('/streamRuns'), repeat),
+            "getGears": measure(get('/getGears'), repeat),
+            "getTotals": measure(get('/getTotals', {'period': 'month'}), repeat),
+        }
+        results["getRuns_page_throughput"] = _throughput(url, sessions, '/getRuns', {'limit': 500},
+                                                         concurrency, max(1, repeat // concurrency))
+        for http in sessions:
+            http.close()
+    finally:
+        _stop()
+    return results
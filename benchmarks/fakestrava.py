@@ -0,0 +1,209 @@
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+import requests.adapters
+
+STRAVA_URL = 'https://www.strava.com'
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 3600
+
+
+def token(athlete_id):
+    """
+    Return the access token accepted by FakeStrava for an athlete
+    """
+    return f"token-{athlete_id}"
+
+
+class _RedirectAdapter(requests.adapters.HTTPAdapter):
+    """
+    Send the requests for www.strava.com to another server
+    """
+
+    def __init__(self, base_url, pool_size=requests.adapters.DEFAULT_POOLSIZE):
+        super().__init__(pool_maxsize=pool_size)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + request.url[len(STRAVA_URL):]
+        return super().send(request, **kwargs)
+
+
+class FakeStrava:
+    """
+    A local HTTP server answering the requests of stravalib for a set of
+    synthetic athletes: /athlete, /athlete/activities, /activities/{id},
+    /activities/{id}/streams and /gear/{id}.
+
+    Every request waits `latency` seconds and the answers carry the rate limit
+    headers of Strava. Once a limit is reached, the requests fail with 429.
+    """
+
+    def __init__(self, athletes, latency=0.0, short_limit=100000, long_limit=1000000, port=0):
+        """
+        :param athletes: a list of benchmarks.synthetic.SyntheticAthlete
+
+        :param latency: the delay in seconds added to every request
+
+        :param short_limit: the number of requests allowed every 15 minutes
+
+        :param long_limit: the number of requests allowed every day
+
+        :param port: the port to listen to, 0 for any free port
+        """
+        self.athletes = {token(athlete.id): athlete for athlete in athletes}
+        self.latency = latency
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.usage = [0, 0]
+        self.windows = [None, None]
+        handler = type('Handler', (_Handler,), {'strava': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fakestrava', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session(self, session: requests.Session | None = None):
+        """
+        Return a requests.Session sending the requests for Strava to this server,
+        to be passed to stravalib.Client or StravaRequest.
+
+        :param session: the session to redirect, e.g. a backend.transport.StravaSession. Default to a new requests.Session
+        """
+        session = session or requests.Session()
+        session.mount(STRAVA_URL, _RedirectAdapter(self.url, getattr(session, 'pool_size', requests.adapters.DEFAULT_POOLSIZE)))
+        return session
+
+    def count_request(self):
+        """
+        Count a request in the rate limit windows. Return False if a limit is exceeded.
+        """
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            for i, window in enumerate((SHORT_WINDOW, LONG_WINDOW)):
+                start = now - now % window
+                if self.windows[i] != start:
+                    self.windows[i] = start
+                    self.usage[i] = 0
+                self.usage[i] += 1
+            return self.usage[0] <= self.short_limit and self.usage[1] <= self.long_limit
+
+    def rate_limit_headers(self):
+        limit = f"{self.short_limit},{self.long_limit}"
+        usage = f"{self.usage[0]},{self.usage[1]}"
+        return {'X-RateLimit-Limit': limit, 'X-RateLimit-Usage': usage,
+                'X-ReadRateLimit-Limit': limit, 'X-ReadRateLimit-Usage': usage}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    strava: FakeStrava = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, do not let them wait for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    ROUTES = (
+        (re.compile(r'^/api/v3/athlete$'), '_athlete'),
+        (re.compile(r'^/api/v3/athlete/activities$'), '_activities'),
+        (re.compile(r'^/api/v3/activities/(\d+)$'), '_activity'),
+        (re.compile(r'^/api/v3/activities/(\d+)/streams$'), '_streams'),
+        (re.compile(r'^/api/v3/gear/(\w+)$'), '_gear'),
+    )
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in self.strava.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send(404, {'message': 'Record Not Found', 'errors': [{'resource': 'Resource', 'field': 'path', 'code': 'invalid'}]})
+
+    def do_GET(self):
+        time.sleep(self.strava.latency)
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if not self.strava.count_request():
+            self._send(429, {'message': 'Rate Limit Exceeded', 'errors': [{'resource': 'Application', 'field': 'rate limit', 'code': 'exceeded'}]})
+            return
+        athlete = self.strava.athletes.get(params.get('access_token') or self.headers.get('Authorization', '').replace('Bearer ', ''))
+        if athlete is None:
+            self._send(401, {'message': 'Authorization Error', 'errors': [{'resource': 'Athlete', 'field': 'access_token', 'code': 'invalid'}]})
+            return
+        for pattern, name in self.ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                getattr(self, name)(athlete, params, *match.groups())
+                return
+        self._not_found()
+
+    def _athlete(self, athlete, params):
+        self._send(200, athlete.athlete_json())
+
+    def _activities(self, athlete, params):
+        activities = athlete.activities
+        if 'before' in params:
+            before = float(params['before'])
+            activities = [a for a in activities if _epoch(a) < before]
+        if 'after' in params:
+            # Strava lists the activities after a date from the oldest
+            after = float(params['after'])
+            activities = [a for a in activities if _epoch(a) > after]
+        else:
+            activities = activities[::-1]
+        per_page = int(params.get('per_page', 30))
+        page = int(params.get('page', 1))
+        self._send(200, [athlete.summary(a) for a in activities[(page - 1) * per_page:page * per_page]])
+
+    def _activity(self, athlete, params, activity_id):
+        activity = athlete.details.get(int(activity_id))
+        if activity is None:
+            self._not_found()
+        else:
+            self._send(200, activity)
+
+    def _streams(self, athlete, params, activity_id):
+        activity = athlete.details.get(int(activity_id))
+        if activity is None:
+            self._not_found()
+        else:
+            types = params['keys'].split(',') if params.get('keys') else None
+            self._send(200, athlete.streams(activity, types))
+
+    def _gear(self, athlete, params, gear_id):
+        gear = athlete.gear_json(gear_id)
+        if gear is None:
+            self._not_found()
+        else:
+            self._send(200, gear)
+
+
+def _epoch(activity):
+    return datetime.strptime(activity['start_date'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
@@ -0,0 +1,49 @@
+import sqlalchemy
+import sqlalchemy.orm
+
+from backend.db import get_db_uri
+from backend.models import Base
+from backend.stravadb import StravaView
+from benchmarks.timing import measure
+
+
+def _legacy_get_runs(config, athlete_id):
+    """
+    Reproduce what getRuns used to do: one engine, one schema check and one
+    session per HTTP request.
+    """
+    engine = sqlalchemy.create_engine(get_db_uri(config))
+    Base.metadata.create_all(engine)
+    view = StravaView.__new__(StravaView)
+    view.athlete_id = athlete_id
+    view.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    activities = view.get_activities()
+    view.close()
+    engine.dispose()
+    return activities
+
+
+def _shared_get_runs(config, athlete_id):
+    """
+    What getRuns does now: reuse the process-wide engine and its pool.
+    """
+    view = StravaView(config, athlete_id)
+    activities = view.get_activities()
+    view.close()
+    return activities
+
+
+def run(config, athlete_id, repeat=50):
+    """
+    Compare the latency of getRuns before and after sharing the engine
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athlete_id: the athlete whose activities are listed
+
+    :param repeat: the number of measured calls for each variant
+    """
+    return {
+        "engine_per_request": measure(lambda: _legacy_get_runs(config, athlete_id), repeat),
+        "shared_engine": measure(lambda: _shared_get_runs(config, athlete_id), repeat),
+    }
@@ -0,0 +1,69 @@
+import json
+
+from cherrypy import _json
+
+from backend.models import Activity, Gear
+from backend.serialize import dumps, orjson
+from backend.stravadb import StravaView
+from benchmarks.timing import measure, per_second
+
+
+def _legacy_get_runs(view: StravaView):
+    """
+    Reproduce what getRuns used to do: hydrate (Activity, Gear.name) ORM rows,
+    call Activity.to_json and encode as the json_out tool.
+    """
+    rows = view.session.query(Activity, Gear.name) \
+        .outerjoin(Gear, Gear.id == Activity.gear_id) \
+        .filter(Activity.athlete == view.athlete_id) \
+        .order_by(Activity.date.desc(), Activity.id.desc()).all()
+    body = b''.join(_json.encode([row[0].to_json() for row in rows]))
+    # Do not let the identity map make the next call cheaper.
+    view.session.expunge_all()
+    return body
+
+
+def _fast_get_runs(view: StravaView, fast_json=False):
+    """
+    What getRuns does now: column tuples formatted by ActivityFormatter and encoded by backend.serialize.dumps.
+    """
+    return dumps(view.get_activities(), fast_json)
+
+
+def run(config, athlete_id, repeat=50):
+    """
+    Compare the throughput of the serialization of getRuns before and after
+    bypassing the ORM, and check that both give the same bytes. With orjson,
+    only the decoded activities can be the same.
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athlete_id: the athlete whose activities are listed
+
+    :param repeat: the number of measured calls for each variant
+    """
+    view = StravaView(config, athlete_id)
+    try:
+        legacy = _legacy_get_runs(view)
+        columns = _fast_get_runs(view)
+        rows = len(json.loads(legacy))
+        legacy_stats = measure(lambda: _legacy_get_runs(view), repeat)
+        columns_stats = measure(lambda: _fast_get_runs(view), repeat)
+        if orjson is not None:
+            fast = _fast_get_runs(view, True)
+            fast_stats = measure(lambda: _fast_get_runs(view, True), repeat)
+    finally:
+        view.close()
+    legacy_stats['rows_per_second'] = per_second(legacy_stats, rows)
+    columns_stats['rows_per_second'] = per_second(columns_stats, rows)
+    report = {
+        "rows": rows,
+        "same_bytes": legacy == columns,
+        "orm_to_json": legacy_stats,
+        "columns_json": columns_stats,
+    }
+    if orjson is not None:
+        fast_stats['rows_per_second'] = per_second(fast_stats, rows)
+        report["orjson_same_activities"] = json.loads(legacy) == json.loads(fast)
+        report["columns_orjson"] = fast_stats
+    return report
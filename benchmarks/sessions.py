@@ -0,0 +1,46 @@
+import requests
+
+from backend.server.sessions import SESSION_STORES
+from benchmarks.endpoints import _start, _stop, _throughput
+from benchmarks.timing import measure
+
+
+def run(config, athletes, repeat=50, concurrency=4):
+    """
+    Measure getRuns over HTTP with every session store, the FileSession of
+    CherryPy and the stores of backend.server.sessions. A small page of
+    activities is requested so that the cost of the session weighs.
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athletes: the list of loaded SyntheticAthlete
+
+    :param repeat: the number of measured requests of each store
+
+    :param concurrency: the number of clients sending requests at once for the throughput
+    """
+    results = {}
+    store = config['session_store']
+    try:
+        for name in SESSION_STORES:
+            config['session_store'] = name
+            url = _start(config)
+            try:
+                sessions = []
+                for athlete in athletes:
+                    http = requests.Session()
+                    http.get(url + '/benchlogin', params={'athlete': athlete.id}).raise_for_status()
+                    sessions.append(http)
+                http = sessions[0]
+                results[name] = {
+                    "getRuns": measure(lambda: http.get(url + '/getRuns', params={'limit': 20}).raise_for_status(), repeat),
+                    "getRuns_throughput": _throughput(url, sessions, '/getRuns', {'limit': 20},
+                                                      concurrency, max(1, repeat // concurrency)),
+                }
+                for http in sessions:
+                    http.close()
+            finally:
+                _stop()
+    finally:
+        config['session_store'] = store
+    return results
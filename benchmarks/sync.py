@@ -0,0 +1,61 @@
+from backend.stravadb import StravaRequest, StravaView
+from benchmarks import synthetic
+from benchmarks.fakestrava import FakeStrava, token
+from benchmarks.timing import measure, per_second
+
+
+def _measure_requests(strava: FakeStrava, func, *args, **kwargs):
+    """
+    Call measure and add the mean number of requests sent to Strava per call
+    """
+    before = strava.requests
+    stats = measure(func, *args, **kwargs)
+    calls = stats['calls'] + kwargs.get('warmup', 2)
+    stats['strava_requests'] = round((strava.requests - before) / calls, 1)
+    return stats
+
+
+def run(config, athletes, strava: FakeStrava, repeat=5):
+    """
+    Measure the synchronizations of StravaView with the fake Strava api for the
+    first synthetic athlete, and the listing of its activities.
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athletes: the list of SyntheticAthlete served by `strava`
+
+    :param strava: a running FakeStrava
+
+    :param repeat: the number of measured calls of each method
+    """
+    athlete = athletes[0]
+    http = strava.session()
+    view = StravaView(config, athlete.id)
+    activities = len(athlete.activities)
+
+    def request():
+        return StravaRequest(config, token(athlete.id), requests_session=http)
+
+    try:
+        synthetic.seed_geocodes(view, athlete)
+        # From an empty db: list, insert and fetch the details of every activity
+        insert = _measure_requests(strava, lambda: view.update_new_activities(request()), repeat,
+                                   warmup=0, setup=lambda: synthetic.clear(view))
+        insert['activities_per_second'] = per_second(insert, activities)
+        # The db is now in sync with Strava
+        rebuild = _measure_requests(strava, lambda: view.rebuild_activities(request()), repeat, warmup=0)
+        rebuild['activities_per_second'] = per_second(rebuild, activities)
+        gears = _measure_requests(strava, lambda: view.update_gears(request()), repeat, warmup=1)
+        listing = measure(view.get_activities, repeat)
+        listing['activities_per_second'] = per_second(listing, activities)
+    finally:
+        view.close()
+        http.close()
+    return {
+        "activities": activities,
+        "latency_s": strava.latency,
+        "insert_new_activities": insert,
+        "rebuild_activities": rebuild,
+        "update_gears": gears,
+        "get_activities": listing,
+    }
@@ -0,0 +1,305 @@
+import math
+import random
+from datetime import datetime, timedelta
+
+import numpy
+import stravalib.model
+
+from backend.constants import ActivityTypes
+from backend.geocache import GeoCache
+from backend.models import Activity, ActivityCurve, ActivityPolyline, ActivityTotal, DataVersion, GeoCode, Gear, PendingDetail, PendingStream, PeriodCurve
+from backend.stravadb import StravaView
+from backend.streams import to_columns
+
+# Synthetic athletes use ids far above the real ones, so that they can be
+# loaded in a copy of a production database and removed afterwards.
+FIRST_ATHLETE_ID = 2_100_000_000
+FIRST_ACTIVITY_ID = 9_000_000_000_000
+ACTIVITIES_PER_ATHLETE = 10_000_000
+# The last day of the generated history, fixed to make the data reproducible
+LAST_DAY = datetime(2024, 12, 31)
+
+# (sport_type, type, weight, median distance in km, median speed in km/h, elevation in m per km, gear)
+SPORTS = (
+    ('Run', 'Run', 40, 10, 11, 8, 'shoes'),
+    ('Ride', 'Ride', 25, 60, 27, 10, 'road'),
+    ('TrailRun', 'Run', 8, 15, 8, 45, 'shoes'),
+    ('MountainBikeRide', 'Ride', 7, 35, 16, 25, 'mtb'),
+    ('GravelRide', 'Ride', 6, 50, 21, 12, 'gravel'),
+    ('Hike', 'Hike', 6, 12, 4, 60, None),
+    ('Walk', 'Walk', 5, 5, 5, 5, None),
+    ('NordicSki', 'NordicSki', 3, 18, 12, 15, None),
+)
+FRAME_TYPES = {'mtb': 1, 'road': 3, 'gravel': 5}
+# A few home towns, the activities start around them
+HOMES = ((45.1885, 5.7245), (48.8566, 2.3522), (43.6047, 1.4442), (46.5197, 6.6323), (44.8378, -0.5792))
+# Radius in degrees of the area where the activities start
+START_SPREAD = 0.03
+POLYLINE_POINTS = 40
+
+
+def encode_polyline(points):
+    """
+    Encode a list of (lat, lon) pairs with the Google polyline algorithm, as Strava does
+    """
+    out = []
+    previous = (0, 0)
+    for point in points:
+        current = (int(round(point[0] * 1e5)), int(round(point[1] * 1e5)))
+        for value, last in zip(current, previous):
+            delta = value - last
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                out.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            out.append(chr(delta + 63))
+        previous = current
+    return ''.join(out)
+
+
+def _pick_day(rng: random.Random, years):
+    """
+    Draw a day of the history, more often in summer and on week-ends
+    """
+    first = LAST_DAY - timedelta(days=365 * years)
+    while True:
+        day = first + timedelta(days=rng.randrange(365 * years))
+        season = 0.6 + 0.4 * math.sin(2 * math.pi * (day.timetuple().tm_yday - 100) / 365)
+        weekend = 1.0 if day.weekday() >= 5 else 0.5
+        if rng.random() < season * weekend:
+            return day
+
+
+class SyntheticAthlete:
+    """
+    An athlete with its gears and activities, in the format of the Strava API
+    """
+
+    def __init__(self, index, n_activities, seed=0, years=5):
+        """
+        :param index: the rank of the athlete, from 0
+
+        :param n_activities: the number of activities
+
+        :param seed: the seed of the random generator
+
+        :param years: the number of years covered by the activities
+        """
+        rng = random.Random(f"{seed}-{index}")
+        self.id = FIRST_ATHLETE_ID + index
+        self.home = HOMES[index % len(HOMES)]
+        self.gears = self._gears(rng)
+        self.details = {}
+        days = sorted(_pick_day(rng, years) for _ in range(n_activities))
+        weights = [sport[2] for sport in SPORTS]
+        for rank, day in enumerate(days):
+            sport = rng.choices(SPORTS, weights)[0]
+            activity = self._activity(rng, FIRST_ACTIVITY_ID + index * ACTIVITIES_PER_ATHLETE + rank, day, sport)
+            self.details[activity['id']] = activity
+        self.activities = list(self.details.values())
+
+    def _gears(self, rng):
+        gears = []
+        for kind in ('road', 'mtb', 'gravel'):
+            if kind == 'road' or rng.random() < 0.6:
+                gears.append({'id': f"b{self.id}{len(gears)}", 'kind': kind, 'name': f"{kind.capitalize()} bike {len(gears)}",
+                              'frame_type': FRAME_TYPES[kind], 'retired': False})
+        for rank in range(rng.randint(2, 4)):
+            # The oldest shoes are worn out
+            gears.append({'id': f"g{self.id}{rank}", 'kind': 'shoes', 'name': f"Shoes {rank}", 'frame_type': None,
+                          'retired': rank == 0})
+        return gears
+
+    def _activity(self, rng, activity_id, day, sport):
+        sport_type, activity_type, _, distance, speed, climb, gear_kind = sport
+        distance_km = max(1.0, rng.lognormvariate(math.log(distance), 0.4))
+        speed_kmh = max(2.0, rng.gauss(speed, speed * 0.12))
+        moving_time = int(distance_km / speed_kmh * 3600)
+        start = day + timedelta(hours=rng.randint(6, 19), minutes=rng.randrange(60))
+        lat = self.home[0] + rng.uniform(-START_SPREAD, START_SPREAD)
+        lon = self.home[1] + rng.uniform(-START_SPREAD, START_SPREAD)
+        gears = [g for g in self.gears if g['kind'] == gear_kind]
+        gear_id = rng.choice(gears)['id'] if gears else None
+        commute = sport_type == 'Ride' and day.weekday() < 5 and rng.random() < 0.3
+        has_heartrate = rng.random() < 0.8
+        average_heartrate = round(rng.gauss(140, 12), 1) if has_heartrate else None
+        track = [(lat, lon)]
+        for _ in range(POLYLINE_POINTS - 1):
+            track.append((track[-1][0] + rng.gauss(0, 0.002), track[-1][1] + rng.gauss(0, 0.002)))
+        return {
+            'id': activity_id,
+            'resource_state': 3,
+            'athlete': {'id': self.id, 'resource_state': 1},
+            'name': f"{sport_type} {start:%d/%m}" + (" commute" if commute else ""),
+            'distance': round(distance_km * 1000, 1),
+            'moving_time': moving_time,
+            'elapsed_time': int(moving_time * rng.uniform(1.0, 1.3)),
+            'total_elevation_gain': round(distance_km * climb * rng.uniform(0.5, 1.5), 1),
+            'type': activity_type,
+            'sport_type': sport_type,
+            'start_date': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_date_local': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'timezone': '(GMT+01:00) Europe/Paris',
+            'start_latlng': [round(lat, 6), round(lon, 6)],
+            'end_latlng': [round(track[-1][0], 6), round(track[-1][1], 6)],
+            'gear_id': gear_id,
+            'average_speed': round(speed_kmh / 3.6, 3),
+            'max_speed': round(speed_kmh / 3.6 * 1.6, 3),
+            'commute': commute,
+            'trainer': False,
+            'manual': False,
+            'private': False,
+            'map': {'id': f"a{activity_id}", 'summary_polyline': encode_polyline(track), 'resource_state': 2},
+            'description': f"Synthetic activity {activity_id}",
+            'calories': round(distance_km * rng.uniform(40, 70), 1),
+            'has_heartrate': has_heartrate,
+            'average_heartrate': average_heartrate,
+            'max_heartrate': round(average_heartrate + rng.uniform(15, 40)) if has_heartrate else None,
+            'suffer_score': rng.randint(5, 250) if has_heartrate else None,
+        }
+
+    def summary(self, activity):
+        """
+        Return an activity as listed by /athlete/activities
+        """
+        summary = {k: v for k, v in activity.items()
+                   if k not in ('description', 'calories', 'average_heartrate', 'max_heartrate', 'suffer_score')}
+        summary['resource_state'] = 2
+        return summary
+
+    def streams(self, activity, types=None):
+        """
+        Return the streams of an activity as returned by /activities/{id}/streams
+        with key_by_type, one sample per second of moving time. The values only
+        depend on the activity.
+
+        :param activity: an activity of the athlete
+
+        :param types: the stream types to return, default to all of them
+        """
+        rng = numpy.random.default_rng(activity['id'])
+        n = max(2, activity['moving_time'])
+        time = numpy.arange(n)
+        # Slow variations around the average speed
+        drift = numpy.convolve(rng.normal(0, 1, n), numpy.ones(60) / 60, mode='same')
+        velocity = numpy.clip(activity['average_speed'] * (1 + 0.8 * drift), 0.3, None)
+        climb = numpy.convolve(rng.normal(0, 1, n), numpy.ones(120) / 120, mode='same')
+        altitude = 200 + numpy.cumsum(climb) * activity['total_elevation_gain'] / max(1.0, numpy.abs(climb).sum()) * 2
+        start, end = numpy.array(activity['start_latlng']), numpy.array(activity['end_latlng'])
+        path = start + numpy.outer(numpy.linspace(0, 1, n), end - start) + numpy.cumsum(rng.normal(0, 2e-5, (n, 2)), axis=0)
+        streams = {'time': time, 'velocity_smooth': numpy.round(velocity, 3), 'altitude': numpy.round(altitude, 1),
+                   'latlng': numpy.round(path, 6)}
+        if activity['has_heartrate']:
+            streams['heartrate'] = numpy.round(activity['average_heartrate'] + 15 * drift + rng.normal(0, 2, n))
+        if activity['type'] == 'Ride':
+            power = 0.4 * velocity ** 3 / 10 + 8 * velocity + 300 * numpy.clip(numpy.gradient(altitude), 0, None)
+            streams['watts'] = numpy.round(numpy.clip(power + rng.normal(0, 15, n), 0, 1500))
+            streams['cadence'] = numpy.round(numpy.clip(85 + 10 * drift, 0, None))
+        elif activity['type'] == 'Run':
+            streams['cadence'] = numpy.round(numpy.clip(82 + 5 * drift, 0, None))
+        return {name: {'type': name, 'data': values.tolist(), 'series_type': 'time', 'original_size': n, 'resolution': 'high'}
+                for name, values in streams.items() if types is None or name in types}
+
+    def athlete_json(self):
+        """
+        Return the athlete as returned by /athlete, with its active gears
+        """
+        def gear(g):
+            return {'id': g['id'], 'name': g['name'], 'primary': False, 'distance': 0, 'resource_state': 2}
+        active = [g for g in self.gears if not g['retired']]
+        return {
+            'id': self.id,
+            'resource_state': 3,
+            'firstname': 'Synthetic',
+            'lastname': str(self.id),
+            'premium': True,
+            'profile_medium': f"https://example.org/{self.id}/medium.jpg",
+            'profile': f"https://example.org/{self.id}/large.jpg",
+            'bikes': [gear(g) for g in active if g['kind'] != 'shoes'],
+            'shoes': [gear(g) for g in active if g['kind'] == 'shoes'],
+        }
+
+    def gear_json(self, gear_id):
+        """
+        Return a gear as returned by /gear/{id}, None if it does not exist
+        """
+        for g in self.gears:
+            if g['id'] == gear_id:
+                gear = {'id': g['id'], 'name': g['name'], 'primary': False, 'distance': 0, 'resource_state': 3,
+                        'retired': g['retired']}
+                if g['frame_type'] is not None:
+                    gear['frame_type'] = g['frame_type']
+                return gear
+        return None
+
+
+def generate(n_athletes, n_activities, seed=0, years=5):
+    """
+    Return `n_athletes` SyntheticAthlete with `n_activities` activities each
+    """
+    return [SyntheticAthlete(index, n_activities, seed, years) for index in range(n_athletes)]
+
+
+def clear(view: StravaView):
+    """
+    Remove everything the local db knows about the athlete of `view`, its
+    stored streams and heatmap tiles, and commit
+    """
+    session = view.session
+    for model in (Activity, Gear, PendingDetail, PendingStream, ActivityCurve, PeriodCurve, ActivityPolyline, ActivityTotal, DataVersion):
+        session.query(model).filter(model.athlete == view.athlete_id).delete(synchronize_session=False)
+    session.commit()
+    view.streams.delete(view.streams.activity_ids())
+    view.heatmap.clear()
+
+
+def seed_geocodes(view: StravaView, athlete: SyntheticAthlete):
+    """
+    Fill the geocoding cache around the home of the athlete so that loading
+    its activities never calls Nominatim.
+    """
+    step = GeoCache.GRID_STEP
+    span = int(math.ceil(START_SPREAD / step)) + 1
+    lat_cell = GeoCache.cell(athlete.home[0])
+    lon_cell = GeoCache.cell(athlete.home[1])
+    for i in range(lat_cell - span, lat_cell + span + 1):
+        for j in range(lon_cell - span, lon_cell + span + 1):
+            view.session.merge(GeoCode(lat_cell=i, lon_cell=j, lat=(i + 0.5) * step, lon=(j + 0.5) * step,
+                                       location=f"Place {i} {j}", hits=0, last_used=datetime.now()))
+    view.session.commit()
+
+
+def load(view: StravaView, athlete: SyntheticAthlete, with_details=True):
+    """
+    Write the gears and the activities of a synthetic athlete in the local db,
+    as a synchronization with Strava would.
+
+    :param view: a StravaView of the athlete
+
+    :param athlete: a SyntheticAthlete
+
+    :param with_details: also write the detailed fields of the activities
+    """
+    clear(view)
+    seed_geocodes(view, athlete)
+    for g in athlete.gears:
+        gear_type = ActivityTypes.RUN if g['kind'] == 'shoes' else ActivityTypes.FRAME_TYPES[g['frame_type']]
+        view.session.add(Gear(id=g['id'], name=g['name'], type=gear_type, frame_type=g['frame_type'] or 0,
+                              athlete=athlete.id, retired=g['retired']))
+    view.session.commit()
+    view.push_activities(stravalib.model.SummaryActivity.model_validate(athlete.summary(a)) for a in athlete.activities)
+    if with_details:
+        details = [stravalib.model.DetailedActivity.model_validate(a) for a in athlete.activities]
+        for i in range(0, len(details), view.batch_size):
+            view.update_activities_detailed_fields(details[i:i + view.batch_size])
+            view.session.commit()
+
+
+def load_streams(view: StravaView, athlete: SyntheticAthlete):
+    """
+    Store the streams of every activity of a synthetic athlete, as
+    fetch_pending_streams would, without computing the curves.
+    """
+    for activity in athlete.activities:
+        streams = athlete.streams(activity)
+        view.streams.write(activity['id'], to_columns({name: stream['data'] for name, stream in streams.items()}))
@@ -0,0 +1,53 @@
+import time
+import statistics
+
+
+def percentile(samples, q):
+    """
+    Return the `q`-th percentile of `samples` using the nearest-rank method
+
+    :param samples: a non empty list of numbers
+
+    :param q: a percentile between 0 and 100
+    """
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def measure(func, repeat=50, warmup=2, setup=None):
+    """
+    Call `func` `repeat` times and return latency statistics in milliseconds
+
+    :param func: a callable without argument
+
+    :param repeat: the number of measured calls
+
+    :param warmup: the number of calls made before measuring
+
+    :param setup: a callable without argument called before every call of `func`, not measured
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "calls": repeat,
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+    }
+
+
+def per_second(stats, count):
+    """
+    Return the throughput of a call processing `count` items from its statistics returned by measure
+    """
+    return round(count / (stats['mean_ms'] / 1000)) if stats['mean_ms'] else None
@@ -0,0 +1,43 @@
+import stravalib
+
+from backend.ratelimit import RateLimiter
+from backend.transport import StravaSession
+from benchmarks.fakestrava import FakeStrava, token
+from benchmarks.timing import measure
+
+
+def run(config, athletes, strava: FakeStrava, repeat=50):
+    """
+    Measure a call to the fake Strava api with a new requests.Session per
+    client, as stravalib does by default, and with a StravaSession keeping the
+    connections alive. The fake api is plain HTTP, the TLS handshakes saved on
+    the real api come on top of the difference.
+
+    :param config: a dictionary as returned by readconfig.read_config
+
+    :param athletes: the list of SyntheticAthlete served by `strava`
+
+    :param strava: a running FakeStrava
+
+    :param repeat: the number of measured calls
+    """
+    access_token = token(athletes[0].id)
+
+    def new_session():
+        http = strava.session()
+        try:
+            stravalib.Client(access_token=access_token, requests_session=http).get_athlete()
+        finally:
+            http.close()
+
+    limiter = RateLimiter(config['rate_limit_15min'], config['rate_limit_daily'])
+    shared = strava.session(StravaSession(limiter, config['http_concurrency'], config['http_retries']))
+    try:
+        results = {
+            "new_session": measure(new_session, repeat),
+            "shared_session": measure(lambda: stravalib.Client(access_token=access_token, requests_session=shared).get_athlete(), repeat),
+        }
+    finally:
+        shared.close()
+    results["saved_ms_per_call"] = round(results["new_session"]["p50_ms"] - results["shared_session"]["p50_ms"], 3)
+    return results
@@ -0,0 +1,78 @@
+"""
+Build frontend/build from frontend: the scripts and stylesheets get a content
+hash in their name so that they can be cached forever, the html pages are
+rewritten to use them and every text file gets a precompressed .gz variant,
+and a .br one if the brotli module is installed.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+FRONTEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend')
+BUILD_DIR = os.path.join(FRONTEND_DIR, 'build')
+# Directories copied into the build
+ASSET_DIRS = ('app', 'css', 'fonts', 'js')
+# Files renamed with their content hash
+FINGERPRINTED_EXTENSIONS = ('.js', '.css')
+# Files which are worth compressing
+COMPRESSED_EXTENSIONS = ('.js', '.css', '.map', '.html', '.svg', '.eot', '.ttf')
+PAGES = ('index.html', 'forbid.html')
+REFERENCE = re.compile(r'(src|href)="((?:%s)/[^"]+)"' % '|'.join(ASSET_DIRS))
+
+
+def fingerprint(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def precompress(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def build():
+    shutil.rmtree(BUILD_DIR, ignore_errors=True)
+    manifest = {}
+    for directory in ASSET_DIRS:
+        os.makedirs(os.path.join(BUILD_DIR, directory))
+        for name in sorted(os.listdir(os.path.join(FRONTEND_DIR, directory))):
+            source = os.path.join(FRONTEND_DIR, directory, name)
+            if not os.path.isfile(source):
+                continue
+            base, extension = os.path.splitext(name)
+            if extension in FINGERPRINTED_EXTENSIONS:
+                target = f"{directory}/{base}.{fingerprint(source)}{extension}"
+            else:
+                target = f"{directory}/{name}"
+            shutil.copyfile(source, os.path.join(BUILD_DIR, target))
+            manifest[f"{directory}/{name}"] = target
+    for page in PAGES:
+        with open(os.path.join(FRONTEND_DIR, page), encoding='utf8') as f:
+            html = f.read()
+        html = REFERENCE.sub(lambda m: f'{m.group(1)}="build/{manifest.get(m.group(2), m.group(2))}"', html)
+        with open(os.path.join(BUILD_DIR, page), 'w', encoding='utf8') as f:
+            f.write(html)
+    for directory, _, files in os.walk(BUILD_DIR):
+        for name in files:
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                precompress(os.path.join(directory, name))
+    with open(os.path.join(BUILD_DIR, 'manifest.json'), 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"{len(manifest)} assets built into {BUILD_DIR}")
+
+
+if __name__ == '__main__':
+    build()
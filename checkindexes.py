@@ -0,0 +1,28 @@
+import argparse
+import sys
+from backend import config
+from backend.migrations import explain, uses_index
+from backend.models import Gear
+from backend.stravadb import StravaView
+
+parser = argparse.ArgumentParser(description="Check with EXPLAIN that the main queries use the indexes")
+parser.add_argument('athlete_id', type=int, help="the athlete used in the queries")
+args = parser.parse_args()
+
+view = StravaView(config, args.athlete_id)
+checks = [
+    ("get_activities", view._activities_query(), 'ix_activities_athlete_date'),
+    ("get_activities(sport_type)", view._activities_query(sport_type='Ride'), 'ix_activities_athlete_sport_type_date'),
+    ("update_new_activities", view._last_activity_query().limit(1), 'ix_activities_athlete_date'),
+    ("get_gears", view.session.query(Gear).filter(Gear.athlete == args.athlete_id), 'ix_gears_athlete'),
+]
+failed = False
+for name, query, index in checks:
+    plan = explain(view.session, query)
+    ok = uses_index(plan, index)
+    failed = failed or not ok
+    print(f"{'OK' if ok else 'NOT USED'} {name}: {index}")
+    for step in plan:
+        print(f"    {step}")
+view.close()
+sys.exit(1 if failed else 0)
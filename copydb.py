@@ -0,0 +1,52 @@
+"""
+Copy the configured database, usually MySQL, to a SQLite file.
+
+    python ./copydb.py /var/lib/mystrava/strava.db
+
+Then set `url = sqlite:////var/lib/mystrava/strava.db` in the [database]
+section of setup.ini. The destination must not hold any data yet.
+"""
+import argparse
+import os
+import sys
+
+import sqlalchemy
+
+from backend import config
+from backend.db import get_db_uri, make_engine
+from backend.migrations import migrate
+from backend.models import Base, SchemaVersion
+
+parser = argparse.ArgumentParser(description="Copy the database to a SQLite file")
+parser.add_argument('destination', help="the SQLite file to create")
+parser.add_argument('--source', help="the SQLAlchemy url of the source db. Default to the configured one")
+parser.add_argument('--chunk-size', type=int, default=5000, help="number of rows read and written at once")
+args = parser.parse_args()
+
+if os.path.exists(args.destination) and os.path.getsize(args.destination) > 0:
+    parser.error(f"{args.destination} already exists")
+
+source = make_engine(args.source or get_db_uri(config), config)
+destination = make_engine(f"sqlite:///{os.path.abspath(args.destination)}", config)
+Base.metadata.create_all(destination)
+migrate(destination)
+
+failed = False
+with source.connect() as src, destination.connect() as dst:
+    for table in Base.metadata.sorted_tables:
+        # The schema version is written by migrate
+        if table is SchemaVersion.__table__:
+            continue
+        copied = 0
+        result = src.execution_options(stream_results=True, yield_per=args.chunk_size).execute(sqlalchemy.select(table))
+        for rows in result.partitions():
+            dst.execute(table.insert(), [row._asdict() for row in rows])
+            copied += len(rows)
+        dst.commit()
+        expected = src.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(table)).scalar()
+        found = dst.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(table)).scalar()
+        failed = failed or expected != found
+        print(f"{table.name}: {copied} rows copied{'' if expected == found else f', {found} in the copy but {expected} in the source'}")
+    dst.execute(sqlalchemy.text("ANALYZE"))
+    dst.commit()
+sys.exit(1 if failed else 0)
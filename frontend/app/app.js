@@ -61,6 +61,11 @@ var RUNS = 6;
 var HIKES = 7;
 var NORDICSKI = 8;
 
+// Number of activities requested at once by getActivities
+var ACTIVITIES_PAGE_SIZE = 500;
+// Delay in ms between two polls of a background job
+var JOB_POLL_INTERVAL = 2000;
+
 // Sport_type selector
 var sportTypes = [
     "All",
@@ -308,6 +313,43 @@ function StravaController($cookies, $scope, $window, $http, $timeout) {
         })
     }
 
+    // Start a background job and poll its progress until it is over.
+    // Resolve with the finished job, reject if it failed or was cancelled.
+    function runJob(url, params) {
+        return $http.get(url, { params: params }).then((response) => {
+            const jobId = response.data.job_id;
+            function poll() {
+                return $timeout(() => $http.get('jobstatus', { params: { job_id: jobId } }), JOB_POLL_INTERVAL).then((status) => {
+                    const job = status.data;
+                    if (job.status == 'done') {
+                        return job;
+                    }
+                    if (job.status == 'failed' || job.status == 'cancelled') {
+                        vm.updateResponse = "Update " + job.status + (job.message ? ": " + job.message : ".");
+                        return Promise.reject(job);
+                    }
+                    vm.updateResponse = "Update in progress...";
+                    if (job.total > 0) {
+                        vm.updateResponse += " " + job.processed + " / " + job.total;
+                        if (job.eta !== null) {
+                            vm.updateResponse += ", " + job.eta + " s left";
+                        }
+                    }
+                    return poll();
+                });
+            }
+            return poll();
+        });
+    }
+
+    // Reload the activities and the gears once the local db has changed
+    function reloadAll() {
+        return Promise.all([getActivities(), getGears()]).then(() => {
+            updateGearTotals(vm.activities);
+            setGearsNamesForActivities(vm.activities);
+        });
+    }
+
     // Update the activities database
     function updateActivities() {
         vm.updateResponse = "";
@@ -316,13 +358,9 @@ function StravaController($cookies, $scope, $window, $http, $timeout) {
             return;
         }
         vm.updateResponse = "Update in progress...";
-        $http.get('updateactivities').then((response) => {
-        vm.updateResponse = "Activities successfully updated.";
-            addPacetoActivities(response.data);
-            updateGearTotals(response.data);
-            setGearsNamesForActivities(response.data);
-            vm.activities.push.apply(vm.activities, response.data);
-            vm.nTotalItems = vm.activities.length;
+        runJob('updateactivities').then(() => {
+            vm.updateResponse = "Activities successfully updated.";
+            return reloadAll();
         });
     }
 
@@ -333,12 +371,10 @@ function StravaController($cookies, $scope, $window, $http, $timeout) {
             alert("Connect to Strava to update the local DB.");
             return;
         }
-        vm.update_response = "Update in progress...";
-        $http.get('updategears').then((response) => {
+        vm.updateResponse = "Update in progress...";
+        runJob('updategears').then(() => {
             vm.updateResponse = "Gears successfully updated.";
-            initGearsDict(response.data);
-            updateGearTotals(vm.activities);
-            setGearsNamesForActivities(vm.activities);
+            return reloadAll();
         });
     }
 
@@ -350,19 +386,11 @@ function StravaController($cookies, $scope, $window, $http, $timeout) {
         }
         vm.nTotalItems = -1;
         vm.updateInProgress = true;
-        Promise.all([$http.get('updategears'), $http.get('updateactivities')]).then((response) => {
-            const gears_response = response[0];
-            const activities_response = response[1];
+        // The jobs of an athlete run one after the other, gears first.
+        Promise.all([runJob('updategears'), runJob('updateactivities')]).then(() => {
             vm.updateResponse = "Gears and activities successfully updated.";
-            initGearsDict(gears_response.data);
-            addPacetoActivities(activities_response.data);
-            updateGearTotals(activities_response.data);
-            setGearsNamesForActivities(activities_response.data);
-            vm.activities =  response.data;
-            vm.nTotalItems = vm.activities.length;
-            vm.updateInProgress = false;
-
-        }, () => {vm.updateInProgress = false;});
+            return reloadAll();
+        }).then(() => {vm.updateInProgress = false;}, () => {vm.updateInProgress = false;});
     }
 
     // Update the data displayed in the table
@@ -437,22 +465,30 @@ function StravaController($cookies, $scope, $window, $http, $timeout) {
             alert("Connect to Strava to upgrade the local DB.");
             return;
         }
-        $http.get('rebuildactivities').then((response) => {
+        runJob('rebuildactivities').then(() => {
             vm.updateResponse = "Activities list successfully rebuilt.";
-            Promise.all([getActivities(), getGears()]).then(() => {
-                updateGearTotals(vm.activities);
-                setGearsNamesForActivities(vm.activities);
-            });
+            return reloadAll();
         });
     }
 
-    // Get the list of activities.
+    // Get the list of activities page by page, so that the first ones are displayed quickly.
     function getActivities() {
-        return $http.get('getRuns').then((response) => {
-            addPacetoActivities(response.data);
-            vm.activities = response.data;
-            vm.nTotalItems = vm.activities.length;
-        });
+        const activities = [];
+        vm.activities = activities;
+        function getPage(cursor) {
+            return $http.get('getRuns', { params: { limit: ACTIVITIES_PAGE_SIZE, cursor: cursor } }).then((response) => {
+                if (!response.data || !response.data.activities) {
+                    return;
+                }
+                addPacetoActivities(response.data.activities);
+                activities.push.apply(activities, response.data.activities);
+                vm.nTotalItems = activities.length;
+                if (response.data.next_cursor) {
+                    return getPage(response.data.next_cursor);
+                }
+            });
+        }
+        return getPage(undefined);
     }
 
     // Initialize gear dictionary
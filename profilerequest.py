@@ -0,0 +1,25 @@
+"""
+Print the _profile parameter asking the server to profile the requests to a handler,
+signed with the profile_secret of the [server] section of setup.ini.
+
+    python ./profilerequest.py /getRuns
+    curl -b cookies 'http://localhost:8080/getRuns?_profile=...'
+
+The profiles are written to log/profiles. Open the .collapsed file with flamegraph.pl
+or speedscope, the .pstats file with python -m pstats or snakeviz.
+"""
+import argparse
+import time
+import urllib.parse
+
+from backend import config
+from backend.profiling import PARAMETER, sign
+
+parser = argparse.ArgumentParser(description="Sign a request to profile")
+parser.add_argument('path', help="the path of the handler, e.g. /getRuns")
+parser.add_argument('--ttl', type=int, default=3600, help="seconds during which the parameter is valid")
+args = parser.parse_args()
+
+if not config['profile_secret']:
+    parser.error("Set profile_secret in the [server] section of setup.ini first")
+print(urllib.parse.urlencode({PARAMETER: sign(config['profile_secret'], args.path, time.time() + args.ttl)}))
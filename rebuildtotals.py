@@ -0,0 +1,17 @@
+import argparse
+from backend import config
+from backend.db import Session, init_db
+from backend.models import Activity
+from backend.totals import rebuild_totals
+
+parser = argparse.ArgumentParser(description="Rebuild the activity_totals table from the activities table")
+parser.add_argument('athletes', type=int, nargs='*', help="the athletes to rebuild. Default to all of them")
+args = parser.parse_args()
+
+init_db(config)
+session = Session()
+athletes = args.athletes or [row.athlete for row in session.query(Activity.athlete).distinct().all()]
+for athlete_id in athletes:
+    rebuild_totals(session, athlete_id)
+    print(f"Totals rebuilt for athlete {athlete_id}")
+session.close()
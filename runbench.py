@@ -0,0 +1,133 @@
+import argparse
+import contextlib
+import json
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+import sqlalchemy
+
+from backend import app_dir, config
+from backend.db import dispose_engine, get_db_uri
+from backend.stravadb import StravaView
+from benchmarks import curves, endpoints, getruns, serialization, sessions, synthetic, sync, transport
+from benchmarks.fakestrava import FakeStrava
+
+# Suites reading the activities of one athlete, real or synthetic
+ATHLETE_SUITES = {
+    'getruns': getruns.run,
+    'serialization': serialization.run,
+}
+# Suites needing the synthetic athletes and the fake Strava api
+SYNTHETIC_SUITES = ('sync', 'endpoints', 'curves', 'sessions', 'transport')
+
+parser = argparse.ArgumentParser(description="Measure the performance of StravaView and of the StravaUI endpoints")
+parser.add_argument('athlete_id', type=int, nargs='?',
+                    help="measure the activities of this athlete in the configured db. Default to synthetic athletes")
+parser.add_argument('--db-url', action='append',
+                    help="the SQLAlchemy url of the db, required for the synthetic athletes. "
+                         "Repeat it to run the same benchmarks on several databases")
+parser.add_argument('--suite', choices=sorted(ATHLETE_SUITES) + list(SYNTHETIC_SUITES), action='append',
+                    help="the benchmarks to run. Default to all of them")
+parser.add_argument('--repeat', type=int, default=50, help="number of measured calls")
+parser.add_argument('--sync-repeat', type=int, default=3, help="number of measured synchronizations with the fake Strava")
+parser.add_argument('--athletes', type=int, default=3, help="number of synthetic athletes")
+parser.add_argument('--activities', type=int, default=1000, help="number of activities of each synthetic athlete")
+parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic data")
+parser.add_argument('--latency', type=float, default=0.005, help="delay in seconds of every request to the fake Strava")
+parser.add_argument('--concurrency', type=int, default=4, help="number of concurrent clients of the endpoints")
+parser.add_argument('--output', help="write the results to this JSON file instead of the standard output")
+args = parser.parse_args()
+
+suites = args.suite or (list(ATHLETE_SUITES) + ([] if args.athlete_id else list(SYNTHETIC_SUITES)))
+if args.athlete_id is not None and any(suite in SYNTHETIC_SUITES for suite in suites):
+    parser.error("the sync, endpoints, curves, sessions and transport suites only run on synthetic athletes")
+if args.athlete_id is None and not args.db_url:
+    parser.error("--db-url is required to load synthetic athletes, do not pollute the production db")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=app_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def backend_name(url):
+    """
+    Return the url of a database without its password, to label the results
+    """
+    return sqlalchemy.engine.make_url(url).render_as_string(hide_password=True)
+
+
+def run_suites(athletes):
+    results = {}
+    athlete_id = args.athlete_id
+    if athlete_id is None:
+        for athlete in athletes:
+            view = StravaView(config, athlete.id)
+            synthetic.load(view, athlete)
+            view.close()
+        athlete_id = athletes[0].id
+    for suite in suites:
+        print(f"Running {suite}")
+        if suite in ATHLETE_SUITES:
+            results[suite] = ATHLETE_SUITES[suite](config, athlete_id, args.repeat)
+        elif suite == 'sync':
+            strava = FakeStrava(athletes, latency=args.latency).start()
+            try:
+                results[suite] = sync.run(config, athletes, strava, args.sync_repeat)
+            finally:
+                strava.stop()
+        elif suite == 'transport':
+            strava = FakeStrava(athletes, latency=args.latency).start()
+            try:
+                results[suite] = transport.run(config, athletes, strava, args.repeat)
+            finally:
+                strava.stop()
+        elif suite == 'curves':
+            results[suite] = curves.run(config, athletes, args.repeat)
+        elif suite == 'sessions':
+            results[suite] = sessions.run(config, athletes, args.repeat, args.concurrency)
+        else:
+            results[suite] = endpoints.run(config, athletes, args.repeat, args.concurrency)
+    for athlete in athletes:
+        view = StravaView(config, athlete.id)
+        synthetic.clear(view)
+        view.close()
+    return results
+
+
+# Only the fake Strava limits the requests
+config['rate_limit_15min'] = 10 ** 9
+config['rate_limit_daily'] = 10 ** 9
+config['session_dir'] = tempfile.mkdtemp(prefix='mystrava-bench-')
+config['stream_dir'] = tempfile.mkdtemp(prefix='mystrava-bench-streams-')
+
+parameters = {key: value for key, value in vars(args).items() if key not in ('output', 'suite', 'db_url')}
+report = {
+    "commit": git_commit(),
+    "date": datetime.now().isoformat(timespec='seconds'),
+    "parameters": parameters,
+    "results": {},
+}
+# Keep the standard output for the report, the application logs go to stderr.
+with contextlib.redirect_stdout(sys.stderr):
+    athletes = []
+    if args.athlete_id is None:
+        athletes = synthetic.generate(args.athletes, args.activities, args.seed)
+    # The same workload on every database, the results are keyed by database
+    for db_url in args.db_url or [None]:
+        dispose_engine()
+        if db_url:
+            config['db_url'] = db_url
+        name = backend_name(get_db_uri(config))
+        print(f"Benchmarking {name}")
+        report["results"][name] = run_suites(athletes)
+
+if args.output:
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+else:
+    print(json.dumps(report, indent=2))
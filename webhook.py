@@ -0,0 +1,56 @@
+"""
+Manage the Strava webhook subscription of the application and replay recorded events.
+
+    python ./webhook.py subscribe https://example.org/mystrava/webhook
+    python ./webhook.py list
+    python ./webhook.py unsubscribe <subscription_id>
+    python ./webhook.py replay events.jsonl http://localhost:8080/webhook
+
+The replay file holds one event per line, as posted by Strava, e.g.
+
+    {"object_type": "activity", "object_id": 123, "aspect_type": "update", "owner_id": 456, "subscription_id": 789, "updates": {"title": "Lunch"}, "event_time": 1700000000}
+"""
+import argparse
+import json
+import time
+
+import requests
+import stravalib
+
+from backend import config
+
+parser = argparse.ArgumentParser(description="Manage the Strava webhook subscription")
+commands = parser.add_subparsers(dest='command', required=True)
+subscribe = commands.add_parser('subscribe', help="subscribe to the events, Strava validates the callback at once")
+subscribe.add_argument('callback_url', help="the public url of /webhook")
+commands.add_parser('list', help="list the subscriptions of the application")
+unsubscribe = commands.add_parser('unsubscribe', help="delete a subscription")
+unsubscribe.add_argument('subscription_id', type=int)
+replay = commands.add_parser('replay', help="post recorded events to a local server")
+replay.add_argument('events', help="a file with one JSON event per line")
+replay.add_argument('url', nargs='?', default='http://localhost:8080/webhook')
+replay.add_argument('--interval', type=float, default=0, help="seconds between two events")
+args = parser.parse_args()
+
+client = stravalib.Client()
+if args.command == 'subscribe':
+    if config['webhook_verify_token'] is None:
+        parser.error("Set webhook_verify_token in the [strava] section of setup.ini first")
+    subscription = client.create_subscription(config['client_id'], config['client_secret'], args.callback_url,
+                                              config['webhook_verify_token'])
+    print(f"Subscription {subscription.id} created, set webhook_subscription_id = {subscription.id} in setup.ini")
+elif args.command == 'list':
+    for subscription in client.list_subscriptions(config['client_id'], config['client_secret']):
+        print(f"{subscription.id}: {subscription.callback_url}")
+elif args.command == 'unsubscribe':
+    client.delete_subscription(args.subscription_id, config['client_id'], config['client_secret'])
+    print(f"Subscription {args.subscription_id} deleted")
+else:
+    with open(args.events, encoding='utf8') as events:
+        for line in events:
+            if not line.strip():
+                continue
+            response = requests.post(args.url, data=line.encode('utf8'), headers={'Content-Type': 'application/json'}, timeout=10)
+            event = json.loads(line)
+            print(f"{event.get('aspect_type')} {event.get('object_type')} {event.get('object_id')}: {response.status_code}")
+            time.sleep(args.interval)